@@ -0,0 +1,88 @@
+"""
+Times transcoding a set of pages with each HTML parser, and lists the pages
+whose output differs from html5lib's.
+
+	python benchmarks/parser_benchmark.py [directory of .html files]
+
+The pages in tests/fixtures/pages are used by default. Settings come from
+config.py, or from config.py.example if there is none.
+"""
+
+# Standard library imports
+import argparse
+import glob
+import importlib.machinery
+import importlib.util
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if not os.path.exists(os.path.join(ROOT, "config.py")):
+	loader = importlib.machinery.SourceFileLoader("config", os.path.join(ROOT, "config.py.example"))
+	spec = importlib.util.spec_from_loader("config", loader)
+	sys.modules["config"] = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(sys.modules["config"])
+
+# First-party imports
+from utils import html_utils
+from utils.system_utils import load_preset
+
+config = load_preset()
+
+def transcode_all(pages):
+	return [html_utils.transcode_html_uncached(
+		source,
+		"http://example.org/",
+		whitelisted_domains=config.WHITELISTED_DOMAINS,
+		simplify_html=config.SIMPLIFY_HTML,
+		tags_to_unwrap=config.TAGS_TO_UNWRAP,
+		tags_to_strip=config.TAGS_TO_STRIP,
+		attributes_to_strip=config.ATTRIBUTES_TO_STRIP,
+		convert_characters=config.CONVERT_CHARACTERS,
+		conversion_table=config.CONVERSION_TABLE,
+		charset="utf-8",
+	) for source in pages.values()]
+
+def normalize(output):
+	# Whitespace between tags, and a newline after <pre> (which browsers skip), don't matter
+	return re.sub(rb">\s+<", b"><", output.replace(b"<pre>\n", b"<pre>")).strip()
+
+def main():
+	parser = argparse.ArgumentParser(description="Compare the HTML parsers used to transcode pages")
+	parser.add_argument("directory", nargs="?", default=os.path.join(ROOT, "tests", "fixtures", "pages"))
+	parser.add_argument("--repeat", type=int, default=5, help="Runs per parser; the fastest is reported")
+	arguments = parser.parse_args()
+
+	pages = {}
+	for path in sorted(glob.glob(os.path.join(arguments.directory, "*.html"))):
+		with open(path, "rb") as f:
+			pages[os.path.basename(path)] = f.read()
+	size = sum(map(len, pages.values()))
+	print(f"{len(pages)} pages, {size / 1024:.0f} KB")
+
+	outputs = {}
+	for name in ("html5lib", "lxml", "auto"):
+		if name != "html5lib" and not html_utils.LXML_AVAILABLE:
+			print(f"{name}: lxml isn't installed")
+			continue
+		html_utils.HTML_PARSER = name
+		times = []
+		for _ in range(arguments.repeat):
+			start = time.perf_counter()
+			outputs[name] = transcode_all(pages)
+			times.append(time.perf_counter() - start)
+		best = min(times)
+		print(f"{name}: {best * 1000:.1f} ms, {size / best / 1024 / 1024:.2f} MB/s")
+
+	for name in ("lxml", "auto"):
+		if name in outputs:
+			differing = [page for page, a, b in zip(pages, outputs[name], outputs["html5lib"])
+						 if normalize(a) != normalize(b)]
+			print(f"{name} differs from html5lib on {len(differing)} pages: {', '.join(differing)}")
+
+if __name__ == "__main__":
+	main()
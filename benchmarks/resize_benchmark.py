@@ -0,0 +1,81 @@
+"""
+Times optimize_image() on large photos at each IMAGE_RESIZE_QUALITY, and
+shows how far "balanced" and "fast" drift from "best".
+
+	python benchmarks/resize_benchmark.py [photo.jpg ...]
+
+Without arguments, two photos (4000x3000 and 6000x4000) are generated: a
+smooth random picture with fine noise on top, saved as JPEG at quality 90.
+Settings come from config.py, or from config.py.example if there is none.
+"""
+
+# Standard library imports
+import argparse
+import importlib.machinery
+import importlib.util
+import io
+import os
+import sys
+import time
+
+# Third-party imports
+import numpy
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if not os.path.exists(os.path.join(ROOT, "config.py")):
+	loader = importlib.machinery.SourceFileLoader("config", os.path.join(ROOT, "config.py.example"))
+	spec = importlib.util.spec_from_loader("config", loader)
+	sys.modules["config"] = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(sys.modules["config"])
+
+# First-party imports
+from utils.image_utils import RESIZE_QUALITIES, optimize_image
+
+def generate_photo(size, seed=1):
+	rng = numpy.random.default_rng(seed)
+	base = Image.fromarray((rng.random((60, 80, 3)) * 255).astype(numpy.uint8)).resize(size, Image.Resampling.BICUBIC)
+	noise = rng.integers(-20, 20, (size[1], size[0], 1))
+	pixels = numpy.clip(numpy.asarray(base).astype(numpy.int16) + noise, 0, 255).astype(numpy.uint8)
+	output = io.BytesIO()
+	Image.fromarray(pixels).save(output, "JPEG", quality=90)
+	return output.getvalue()
+
+def best_of(function, repeat):
+	times = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = function()
+		times.append(time.perf_counter() - start)
+	return min(times), result
+
+def main():
+	parser = argparse.ArgumentParser(description="Time resizing large photos at each quality setting")
+	parser.add_argument("photos", nargs="*")
+	parser.add_argument("--repeat", type=int, default=5, help="Runs per setting; the fastest is reported")
+	arguments = parser.parse_args()
+
+	if arguments.photos:
+		photos = []
+		for path in arguments.photos:
+			with open(path, "rb") as f:
+				photos.append((os.path.basename(path), f.read()))
+	else:
+		photos = [(f"{width}x{height}.jpg", generate_photo((width, height))) for width, height in ((4000, 3000), (6000, 4000))]
+
+	for name, data in photos:
+		reference = None
+		for quality in sorted(RESIZE_QUALITIES, key=lambda quality: quality != "best"):
+			png_seconds, resized = best_of(lambda: optimize_image(data, convert_to="png", resize_quality=quality), arguments.repeat)
+			gif_seconds, _ = best_of(lambda: optimize_image(data, resize_quality=quality), arguments.repeat)
+			pixels = numpy.asarray(Image.open(io.BytesIO(resized)).convert("RGB")).astype(numpy.float32)
+			if reference is None:
+				reference = pixels
+			drift = numpy.abs(pixels - reference).mean()
+			print(f"{name} {quality:8s}  to PNG {png_seconds * 1000:5.0f} ms  to GIF {gif_seconds * 1000:5.0f} ms  "
+				  f"{pixels.shape[1]}x{pixels.shape[0]}  mean difference from best {drift:.2f}")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,80 @@
+"""
+Measures how much memory transcoding a page allocates at its peak, and how
+many pages a second process_response() gets through, with and without
+SIMPLIFY_HTML.
+
+	python benchmarks/transcode_benchmark.py [page.html] [--charset CHARSET]
+
+By default the page is benchmarks/fixtures/journal-latin1.html, a news page
+in windows-1252. Settings come from config.py, or from config.py.example if
+there is none.
+"""
+
+# Standard library imports
+import argparse
+import contextlib
+import importlib.machinery
+import importlib.util
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if not os.path.exists(os.path.join(ROOT, "config.py")):
+	loader = importlib.machinery.SourceFileLoader("config", os.path.join(ROOT, "config.py.example"))
+	spec = importlib.util.spec_from_loader("config", loader)
+	sys.modules["config"] = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(sys.modules["config"])
+
+# First-party imports
+import proxy
+from utils import html_utils
+
+URL = "http://www.example.fr/"
+
+def transcode(page, charset):
+	# Every run transcodes the page, rather than answering from the memo
+	html_utils.transcode_cache.clear()
+	with contextlib.redirect_stdout(io.StringIO()):
+		return proxy.process_response((page, 200, {"Content-Type": f"text/html; charset={charset}"}), URL)
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure allocations and throughput of transcoding a page")
+	parser.add_argument("page", nargs="?", default=os.path.join(ROOT, "benchmarks", "fixtures", "journal-latin1.html"))
+	parser.add_argument("--charset", default="iso-8859-1", help="Charset the page is declared as")
+	parser.add_argument("--runs", type=int, default=50, help="Pages transcoded per timing; the fastest of 5 is reported")
+	arguments = parser.parse_args()
+
+	with open(arguments.page, "rb") as f:
+		page = f.read()
+	print(f"{os.path.basename(arguments.page)}: {len(page) / 1024:.1f} KB, HTML_PARSER {html_utils.HTML_PARSER}")
+
+	proxy.app.config["MACPROXY_HOST_AND_PORT"] = "127.0.0.1:5001"
+	with proxy.app.test_request_context(URL):
+		for simplify in (False, True):
+			proxy.config.SIMPLIFY_HTML = simplify
+			# Warm up imports, pipelines and transliteration tables first
+			transcode(page, arguments.charset)
+
+			tracemalloc.start()
+			transcode(page, arguments.charset)
+			_, peak = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+
+			best = None
+			for _ in range(5):
+				start = time.perf_counter()
+				for _ in range(arguments.runs):
+					transcode(page, arguments.charset)
+				elapsed = time.perf_counter() - start
+				best = elapsed if best is None else min(best, elapsed)
+			seconds = best / arguments.runs
+			print(f"SIMPLIFY_HTML={simplify}: peak {peak / 1024:.0f} KB ({peak / len(page):.1f}x the page), "
+				  f"{seconds * 1000:.2f} ms per page, {len(page) / seconds / 1024 / 1024:.2f} MB/s")
+
+if __name__ == "__main__":
+	main()
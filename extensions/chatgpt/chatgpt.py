@@ -1,15 +1,15 @@
 from flask import request, render_template_string
 from openai import OpenAI
 import config
+from utils.state_utils import ClientState
 
 # Initialize the OpenAI client with your API key
 client = OpenAI(api_key=config.OPEN_AI_API_KEY)
 
 DOMAIN = "chatgpt.com"
 
-messages = []
-selected_model = "gpt-4o"
-previous_model = selected_model
+state = ClientState("chatgpt")
+default_model = "gpt-4o"
 
 system_prompts = [
 	{"role": "system", "content": "Please provide your response in plain text using only ASCII characters. "
@@ -73,7 +73,9 @@ def handle_post(request):
 	return chat_interface(request), 200
 
 def chat_interface(request):
-	global messages, selected_model, previous_model
+	messages = state.get('messages', [])
+	selected_model = state.get('selected_model', default_model)
+	previous_model = state.get('previous_model', default_model)
 	output = ""
 
 	if request.method == 'POST':
@@ -98,6 +100,10 @@ def chat_interface(request):
 		response_body = response.choices[0].message.content
 		messages.append({"role": "system", "content": response_body})
 
+		state.set('messages', messages)
+		state.set('selected_model', selected_model)
+		state.set('previous_model', previous_model)
+
 	for msg in reversed(messages[-10:]):
 		if msg['role'] == 'user':
 			output += f"<b>User:</b> {msg['content']}<br>"
@@ -1,15 +1,15 @@
 from flask import request, render_template_string
 import anthropic
 import config
+from utils.state_utils import ClientState
 
 # Initialize the Anthropic client with your API key
 client = anthropic.Anthropic(api_key=config.ANTHROPIC_API_KEY)
 
 DOMAIN = "claude.ai"
 
-messages = []
-selected_model = "claude-3-7-sonnet-latest"
-previous_model = selected_model
+state = ClientState("claude")
+default_model = "claude-3-7-sonnet-latest"
 
 system_prompt = """Please provide your response in plain text using only ASCII characters. 
 Never use any special or esoteric characters that might not be supported by older systems.
@@ -67,7 +67,9 @@ def handle_post(request):
 	return chat_interface(request), 200
 
 def chat_interface(request):
-	global messages, selected_model, previous_model
+	messages = state.get('messages', [])
+	selected_model = state.get('selected_model', default_model)
+	previous_model = state.get('previous_model', default_model)
 	output = ""
 
 	if request.method == 'POST':
@@ -100,6 +102,10 @@ def chat_interface(request):
 			response_body = f"An error occurred: {str(e)}"
 			messages.append({"role": "assistant", "content": response_body})
 
+		state.set('messages', messages)
+		state.set('selected_model', selected_model)
+		state.set('previous_model', previous_model)
+
 	for msg in reversed(messages[-10:]):
 		if msg['role'] == 'user':
 			output += f"<b>User:</b> {msg['content']}<br>"
@@ -2,15 +2,15 @@ from flask import request, render_template_string
 from google import genai
 from google.genai import types
 import config
+from utils.state_utils import ClientState
 
 # Initialize the Google API Client with your API key
 client = genai.Client(api_key=config.GEMINI_API_KEY)
 
 DOMAIN = "gemini.google.com"
 
-messages = []
-selected_model = "gemini-2.0-flash"
-previous_model = selected_model
+state = ClientState("gemini")
+default_model = "gemini-2.0-flash"
 
 system_prompt = """Please provide your response in plain text using only ASCII characters. 
 Never use any special or esoteric characters that might not be supported by older systems.
@@ -72,7 +72,9 @@ def handle_post(request):
 	return chat_interface(request), 200
 
 def chat_interface(request):
-	global messages, selected_model, previous_model
+	messages = state.get('messages', [])
+	selected_model = state.get('selected_model', default_model)
+	previous_model = state.get('previous_model', default_model)
 	output = ""
 	
 	if request.method == 'POST':
@@ -114,6 +116,10 @@ def chat_interface(request):
 			error_message = f"Error: {str(e)}"
 			messages.append({"role": "user", "content": user_input})
 			messages.append({"role": "assistant", "content": error_message})
+
+		state.set('messages', messages)
+		state.set('selected_model', selected_model)
+		state.set('previous_model', previous_model)
 	
 	# Generate output HTML
 	for msg in reversed(messages[-10:]):  # Show last 10 messages
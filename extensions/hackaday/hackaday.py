@@ -1,7 +1,7 @@
 ''' WARNING ! This module is (perhaps appropriately) very hacky. Avert your gaze... '''
 
 from flask import request, redirect, render_template_string
-import requests
+from utils import http_cache
 from bs4 import BeautifulSoup, Comment
 from datetime import datetime
 import re
@@ -567,14 +567,13 @@ fresh hacks every day                 /___/
 	for element in soup(text=lambda text: isinstance(text, str) and not text.strip()):
 		element.extract()
 
-	# Convert problem characters and return
-	updated_html = str(soup)
-	return updated_html
+	# Return the tree itself, so the proxy doesn't have to parse it again
+	return soup
 
 def handle_get(req):
 	url = f"https://hackaday.com{req.path}"
 	try:
-		response = requests.get(url)
+		response = http_cache.get(url)
 		processed_content = process_html(response.text, url)
 		return processed_content, response.status_code
 	except Exception as e:
@@ -591,7 +590,7 @@ def handle_request(req):
 				url += f"?{req.query_string.decode('utf-8')}"
 		
 		try:
-			response = requests.get(url)
+			response = http_cache.get(url)
 			processed_content = process_html(response.text, url)
 			return processed_content, response.status_code
 		except Exception as e:
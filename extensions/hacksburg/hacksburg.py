@@ -1,5 +1,5 @@
 from flask import request
-import requests
+from utils import http_cache
 from bs4 import BeautifulSoup
 from datetime import datetime
 import json
@@ -195,14 +195,14 @@ def process_html(content, path):
 def handle_get(req):
 	url = f"https://{DOMAIN}{req.path}"
 	try:
-		response = requests.get(url)
+		response = http_cache.get(url)
 		processed_content = process_html(response.text, req.path)
 
 		# Only append posts for the homepage
 		if req.path == "/":
 			# Retrieve and process JSON data
 			json_url = "https://hacksburg.org/posts.json"
-			json_response = requests.get(json_url)
+			json_response = http_cache.get(json_url)
 			if json_response.status_code == 200:
 				data = json_response.json()
 
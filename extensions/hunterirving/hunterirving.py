@@ -1,5 +1,6 @@
 from flask import request
 import requests
+from utils import http_cache
 from bs4 import BeautifulSoup
 from datetime import datetime, timedelta
 import mimetypes
@@ -31,7 +32,7 @@ def handle_request(req):
 	if req.host == DOMAIN:
 		url = f"https://{DOMAIN}{req.path}"
 		try:
-			response = requests.get(url)
+			response = http_cache.get(url)
 			response.raise_for_status()  # Raise an exception for bad status codes
 			
 			# Check if the content is an image	
@@ -137,10 +138,8 @@ def handle_request(req):
 						final_div.wrap(font_tag)
 						final_div.insert_after(soup.new_tag('br'))
 
-			# Convert the soup back to a string for all paths
-			modified_html = str(soup)
-			
-			return modified_html, response.status_code
+			# Return the tree itself for all paths, so the proxy doesn't have to parse it again
+			return soup, response.status_code
 
 		except requests.RequestException as e:
 			return f"Error: {str(e)}", 500
@@ -1,5 +1,5 @@
 from flask import request, redirect
-import requests
+from utils import http_cache
 from bs4 import BeautifulSoup
 
 DOMAIN = "npr.org"
@@ -13,7 +13,7 @@ DOMAIN = "npr.org"
 def handle_get(req):
 	url = f"https://text.npr.org{req.path}"
 	try:
-		response = requests.get(url)
+		response = http_cache.get(url)
 
 		# Parse the HTML and remove the <header> tag
 		soup = BeautifulSoup(response.text, 'html.parser')
@@ -28,7 +28,7 @@ def handle_get(req):
 			if tag.has_attr('src'):
 				tag['src'] = f"/{tag['src'].lstrip('/')}"
 
-		return str(soup), response.status_code
+		return soup, response.status_code
 	except Exception as e:
 		return f"Error: {str(e)}", 500
 
@@ -1,4 +1,5 @@
 from flask import request, render_template_string
+from utils.state_utils import ClientState
 
 DOMAIN = "override.test"
 
@@ -22,21 +23,20 @@ HTML_TEMPLATE = """
 </html>
 """
 
-override_active = False
+state = ClientState("override")
 
 def get_override_status():
-	global override_active
-	return override_active
+	return state.get('override_active', False)
 
 def handle_request(req):
-	global override_active
-
 	if req.method == 'POST':
 		action = req.form.get('action')
 		if action == 'Enable Override':
-			override_active = True
+			state.set('override_active', True)
 		elif action == 'Disable Override':
-			override_active = False
+			state.set('override_active', False)
+
+	override_active = get_override_status()
 
 	status = "Override Active" if override_active else "Override Inactive"
 	
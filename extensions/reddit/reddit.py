@@ -1,4 +1,5 @@
 import requests
+from utils import http_cache
 from bs4 import BeautifulSoup
 from flask import Response
 import io
@@ -23,7 +24,7 @@ def handle_request(request):
 	
 	try:
 		headers = {'User-Agent': USER_AGENT} if USER_AGENT else {}
-		resp = requests.get(url, headers=headers, allow_redirects=True, timeout=10)
+		resp = http_cache.get(url, headers=headers, allow_redirects=True, timeout=10)
 		resp.raise_for_status()
 		return process_content(resp.content, url)
 	except requests.RequestException as e:
@@ -278,14 +279,14 @@ def process_content(content, url):
 			if prev_button and prev_button.find('a'):
 				prev_link = prev_button.find('a')
 				new_prev = new_soup.new_tag('a', href=prev_link['href'].replace('old.reddit.com', 'reddit.com'))
-				new_prev.string = '&lt; prev'
+				new_prev.string = '< prev'
 				nav_left.append(new_prev)
 
 			next_button = nav_buttons.find('span', class_='next-button')
 			if next_button and next_button.find('a'):
 				next_link = next_button.find('a')
 				new_next = new_soup.new_tag('a', href=next_link['href'].replace('old.reddit.com', 'reddit.com'))
-				new_next.string = 'next &gt;'
+				new_next.string = 'next >'
 				nav_right.append(new_next)
 
-	return str(new_soup), 200
\ No newline at end of file
+	return new_soup, 200
\ No newline at end of file
@@ -7,10 +7,10 @@ import calendar
 import re
 import os
 import time
+from utils.state_utils import ClientState
 
 DOMAIN = "web.archive.org"
-TARGET_DATE = "19960101"
-date_update_message = ""
+TARGET_DATE = "19960101"  # Default until a client picks a date
 last_request_time = 0
 REQUEST_DELAY = 0.2  # Minimum time between requests in seconds
 
@@ -20,6 +20,14 @@ USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36
 session = requests.Session()
 session.headers.update({'User-Agent': USER_AGENT})
 
+def reset_session():
+	# Pooled connections must not be shared with a forked worker process
+	global session
+	session = requests.Session()
+	session.headers.update({'User-Agent': USER_AGENT})
+
+os.register_at_fork(after_in_child=reset_session)
+
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
@@ -67,17 +75,19 @@ HTML_TEMPLATE = """
 </html>
 """
 
-override_active = False
+state = ClientState("waybackmachine")
 current_date = datetime.datetime.now()
-selected_month = current_date.strftime("%b").upper()
-selected_day = current_date.day
-selected_year = 1996
+default_month = current_date.strftime("%b").upper()
+default_day = current_date.day
+default_year = 1996
 current_year = current_date.year
 months = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
 
+def get_target_date():
+	return state.get('target_date', TARGET_DATE)
+
 def get_override_status():
-	global override_active
-	return override_active
+	return state.get('override_active', False)
 
 def rate_limit_request():
 	"""Implement rate limiting between requests"""
@@ -99,13 +109,14 @@ def construct_wayback_url(url, timestamp):
 
 def find_closest_snapshot(url):
 	"""Use Wayback CDX API to find closest available snapshot"""
+	target_date = get_target_date()
 	try:
 		cdx_url = f"https://web.archive.org/cdx/search/cdx"
 		params = {
 			'url': url,
 			'matchType': 'prefix',
 			'limit': -1,  # Get all results
-			'from': TARGET_DATE,  # Start from our target date
+			'from': target_date,  # Start from our target date
 			'output': 'json',
 			'sort': 'closest',
 			'filter': '!statuscode:[500 TO 599]'  # Exclude server errors
@@ -117,7 +128,7 @@ def find_closest_snapshot(url):
 			if len(data) > 1:  # First row is header
 				# Sort snapshots to prefer earlier dates
 				snapshots = data[1:]  # Skip header row
-				target_timestamp = int(TARGET_DATE + "000000")
+				target_timestamp = int(target_date + "000000")
 				
 				# Sort by absolute difference from target date, but prefer later dates
 				snapshots.sort(key=lambda x: (
@@ -131,7 +142,7 @@ def find_closest_snapshot(url):
 					
 	except Exception as e:
 		print(f"Error finding snapshot: {str(e)}")
-	return TARGET_DATE + "000000"  # Return target date if no snapshot found
+	return target_date + "000000"  # Return target date if no snapshot found
 
 def make_archive_request(url, follow_redirects=True, original_timestamp=None):
 	"""Make a request to the archive with rate limiting and redirect handling"""
@@ -269,13 +280,16 @@ def process_html_content(content, base_url):
 					lambda m: f'url("{extract_original_url(m.group(1), base_url)}")',
 					style_tag.string)
 
-		return str(soup)
+		return soup
 	except Exception as e:
 		print(f"Error in process_html_content: {str(e)}")
 		return content
 
 def handle_request(req):
-	global override_active, selected_month, selected_day, selected_year, TARGET_DATE, date_update_message
+	selected_month = state.get('selected_month', default_month)
+	selected_day = state.get('selected_day', default_day)
+	selected_year = state.get('selected_year', default_year)
+	date_update_message = state.get('date_update_message', "")
 
 	parsed_url = urlparse(req.url)
 	is_wayback_domain = parsed_url.netloc == DOMAIN
@@ -284,13 +298,13 @@ def handle_request(req):
 		if req.method == 'POST':
 			action = req.form.get('action')
 			if action == 'enable':
-				override_active = True
+				state.set('override_active', True)
 				date_update_message = ""
 			elif action == 'disable':
-				override_active = False
+				state.set('override_active', False)
 				date_update_message = ""
 			elif action == 'set date':
-				override_active = True
+				state.set('override_active', True)
 				
 				selected_month = req.form.get('month')
 				selected_day = int(req.form.get('day'))
@@ -311,12 +325,17 @@ def handle_request(req):
 				selected_day = selected_date.day
 
 				month_num = str(selected_date.month).zfill(2)
-				TARGET_DATE = f"{selected_year}{month_num}{str(selected_day).zfill(2)}"
+				state.set('target_date', f"{selected_year}{month_num}{str(selected_day).zfill(2)}")
 				
 				date_update_message = f"{selected_month} {selected_day}, {selected_year}"
 
+				state.set('selected_month', selected_month)
+				state.set('selected_day', selected_day)
+				state.set('selected_year', selected_year)
+			state.set('date_update_message', date_update_message)
+
 		return render_template_string(HTML_TEMPLATE, 
-								   override_active=override_active,
+								   override_active=get_override_status(),
 								   months=months,
 								   selected_month=selected_month,
 								   selected_day=selected_day,
@@ -1,5 +1,5 @@
 from flask import request, redirect
-import requests
+from utils import http_cache
 from bs4 import BeautifulSoup
 import config
 import urllib.parse
@@ -59,7 +59,7 @@ def handle_request(req):
 			encoded_location = urllib.parse.quote(location)
 			full_url = base_url + encoded_location
 			
-			response = requests.get(full_url)
+			response = http_cache.get(full_url)
 			processed_content = process_html(response.text)
 			return processed_content, response.status_code
 		except Exception as e:
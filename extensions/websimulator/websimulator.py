@@ -7,6 +7,7 @@ import config
 import importlib.util
 import os
 from urllib.parse import urlparse, parse_qs
+from utils.state_utils import ClientState
 
 client = anthropic.Anthropic(api_key=config.ANTHROPIC_API_KEY)
 
@@ -126,25 +127,22 @@ if hasattr(config, 'PRESET') and config.PRESET:
 # Combine the prompts once at module initialization
 FULL_SYSTEM_PROMPT = SYSTEM_PROMPT + "\n\n" + PRESET_PROMPT_ADDENDUM
 
-override_active = False
-message_history = []
+state = ClientState("websimulator")
 total_spend = 0.00
 
 def get_override_status():
-	global override_active
-	return override_active
+	return state.get('override_active', False)
 
 def handle_request(req):
-	global override_active, message_history
-
 	parsed_url = urlparse(req.url)
 	is_websimulator_domain = parsed_url.netloc == DOMAIN
 
 	if is_websimulator_domain:
 		if req.method == 'POST' and req.form.get('action') in ['enable', 'disable']:
 			action = req.form.get('action')
-			override_active = (action == 'enable')
+			state.set('override_active', action == 'enable')
 
+		override_active = get_override_status()
 		status = "websimulator enabled" if override_active else "websimulator disabled"
 		return render_template_string(WEBSIMULATOR_TEMPLATE, 
 									status=status, 
@@ -157,8 +155,8 @@ def format_cost(cost):
 	return f"{GREEN}{formatted[:formatted.index('.')+3]}{RESET}{formatted[formatted.index('.')+3:]}"
 
 def simulate_web_request(req):
-	global message_history
 	global total_spend
+	message_history = state.get('message_history', [])
 
 	# Parse the request
 	parsed_url = urlparse(req.url)
@@ -211,6 +209,7 @@ def simulate_web_request(req):
 		message_history.append({"request": current_request_content, "response": simulated_content})
 		if len(message_history) > MAX_HISTORY:
 			message_history.pop(0)
+		state.set('message_history', message_history)
 
 		return simulated_content
 	except Exception as e:
@@ -2,6 +2,7 @@
 
 from flask import request
 import requests
+from utils import http_cache
 from bs4 import BeautifulSoup, Comment
 import urllib.parse
 import re
@@ -22,7 +23,7 @@ def create_search_form():
 
 def get_featured_article_snippet():
 	try:
-		response = requests.get("https://en.wikipedia.org/wiki/Main_Page")
+		response = http_cache.get("https://en.wikipedia.org/wiki/Main_Page")
 		response.raise_for_status()
 		soup = BeautifulSoup(response.text, 'html.parser')
 		tfa_div = soup.find('div', id='mp-tfa')
@@ -69,7 +70,7 @@ def handle_wiki_page(title):
 	}
 	
 	try:
-		search_response = requests.get(search_url, params=params)
+		search_response = http_cache.get(search_url, params=params)
 		search_response.raise_for_status()
 		search_data = search_response.json()
 
@@ -79,7 +80,7 @@ def handle_wiki_page(title):
 			
 			# Now fetch the page using the found title
 			url = f"https://{DOMAIN}/wiki/{urllib.parse.quote(found_title)}"
-			response = requests.get(url)
+			response = http_cache.get(url)
 			response.raise_for_status()
 
 			soup = BeautifulSoup(response.text, 'html.parser')
@@ -25,8 +25,10 @@ CAN_RENDER_INLINE_IMAGES = False
 RESIZE_IMAGES = True
 MAX_IMAGE_WIDTH = 512
 MAX_IMAGE_HEIGHT = 342
+IMAGE_RESIZE_QUALITY = "balanced"
 CONVERT_IMAGES = True
 CONVERT_IMAGES_TO_FILETYPE = "gif"
+IMAGE_COLOR_MODE = "BLACK_AND_WHITE"
 DITHERING_ALGORITHM = "FLOYDSTEINBERG"
 
 WEB_SIMULATOR_PROMPT_ADDENDUM = """<formatting>
@@ -10,8 +10,10 @@ CAN_RENDER_INLINE_IMAGES = True
 RESIZE_IMAGES = False
 MAX_IMAGE_WIDTH = None
 MAX_IMAGE_HEIGHT = None
+IMAGE_RESIZE_QUALITY = "balanced"
 CONVERT_IMAGES = False
 CONVERT_IMAGES_TO_FILETYPE = None
+IMAGE_COLOR_MODE = None
 DITHERING_ALGORITHM = None
 
 WEB_SIMULATOR_PROMPT_ADDENDUM = """<formatting>
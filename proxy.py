@@ -1,49 +1,97 @@
 # Standard library imports
 import argparse
 import os
-import shutil
 import socket
+import tempfile
 from urllib.parse import urlparse
 
 # Third-party imports
-import requests
-from flask import Flask, request, session, g, abort, Response, send_from_directory
+from bs4 import BeautifulSoup
+from flask import Flask, request, session, g, abort, Response, send_from_directory, stream_with_context
 from werkzeug.serving import get_interface_ip
 from werkzeug.wrappers.response import Response as WerkzeugResponse
 
 # First-party imports
-from utils.html_utils import transcode_html, transcode_content
-from utils.image_utils import is_image_url, fetch_and_cache_image, CACHE_DIR
+from utils.html_utils import transcode_html, transcode_content, transcode_content_stream, get_transcode_cache_stats, transcode_cache, was_stripped
+from utils.http_cache import CachingSession, cache as http_cache, get_stats as get_http_cache_stats
+from utils.image_cache import cache as image_cache
+from utils.image_utils import ImageTooLarge, is_image_url, fetch_and_cache_image, get_image_stats, is_cached_image_name, read_image, wait_for_image
+from utils.pool_utils import start_worker_pools, stop_worker_pools
+from utils.server_utils import serve_production, serve_prefork
+from utils.state_utils import ClientState, attach_client_cookie, is_shared_backend, set_backend, use_shared_backend
+from utils.stream_utils import STREAM_HTML, STREAM_HTML_CHUNK_SIZE, stream_transcode_html
 from utils.system_utils import load_preset
+from utils.text_utils import OUTPUT_ENCODING, charset_from_content_type, set_charset
 
 
-os.environ['FLASK_ENV'] = 'development'
 app = Flask(__name__)
-session = requests.Session()
+session = CachingSession()
+
+def reset_session():
+	# Pooled connections must not be shared with a forked worker process
+	global session
+	session = CachingSession()
+
+os.register_at_fork(after_in_child=reset_session)
 
 HTTP_ERRORS = (403, 404, 500, 503, 504)
 ERROR_HEADER = "[[Macproxy Encountered an Error]]"
 
-# Global variable to store the override extension
-override_extension = None
+# List of content types that should not be transcoded
+NON_TRANSCODE_TYPES = [
+	'application/octet-stream',
+	'application/pdf',
+	'application/zip',
+	'application/x-zip-compressed',
+	'application/x-rar-compressed',
+	'application/x-tar',
+	'application/x-gzip',
+	'application/x-bzip2',
+	'application/x-7z-compressed',
+	'application/vnd.openxmlformats-officedocument',
+	'application/vnd.ms-excel',
+	'application/vnd.ms-powerpoint',
+	'application/msword',
+	'audio/',
+	'video/',
+	'text/plain'
+]
+
+# Stylesheets and scripts have their https:// references rewritten
+SCRIPT_AND_STYLE_TYPES = ['text/css', 'text/javascript', 'application/javascript', 'application/x-javascript']
+
+# Pass-through responses are relayed to the client in chunks of this size
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Upstream headers that describe the connection rather than the content
+HOP_BY_HOP_HEADERS = ['connection', 'keep-alive', 'transfer-encoding', 'content-encoding', 'content-length']
+
+# Stores each client's override extension
+proxy_state = ClientState("proxy")
 
 # User-Agent string
 USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
 
-# Call this function every time the proxy starts
-def clear_image_cache():
-	if os.path.exists(CACHE_DIR):
-		shutil.rmtree(CACHE_DIR)
-	os.makedirs(CACHE_DIR, exist_ok=True)
-
-clear_image_cache()
-
 # Load preset immediately after config import
 config = load_preset()
 
 # Now get the settings we need after preset has potentially modified them
 ENABLED_EXTENSIONS = config.ENABLED_EXTENSIONS
 
+# Pick the store for per-client state before extensions start using it
+STATE_BACKEND = getattr(config, 'STATE_BACKEND', 'memory')
+if STATE_BACKEND == 'sqlite':
+	use_shared_backend(getattr(config, 'STATE_SQLITE_PATH', 'macproxy_state.sqlite'), reset=False)
+elif isinstance(STATE_BACKEND, str):
+	if STATE_BACKEND != 'memory':
+		print(f"Unknown STATE_BACKEND {STATE_BACKEND!r}: use \"memory\", \"sqlite\" or a store object, exiting.")
+		quit()
+elif all(callable(getattr(STATE_BACKEND, method, None)) for method in ('get', 'set', 'delete')):
+	set_backend(STATE_BACKEND)
+else:
+	print(f"STATE_BACKEND {type(STATE_BACKEND).__name__} has no get, set and delete methods, exiting.")
+	quit()
+
 # Load extensions
 extensions = {}
 domain_to_extension = {}
@@ -54,9 +102,33 @@ for ext in ENABLED_EXTENSIONS:
 	extensions[ext] = module
 	domain_to_extension[module.DOMAIN] = module
 
-@app.route("/cached_image/<path:filename>")
+@app.route("/cached_image/<filename>")
 def serve_cached_image(filename):
-	return send_from_directory(CACHE_DIR, filename, mimetype='image/gif')
+	# The name comes straight from the request, so it's checked before it's used as a path
+	if not is_cached_image_name(filename):
+		return abort(404)
+	# Inline SVGs may still be waiting to be converted
+	wait_for_image(filename)
+	return send_cached_image(filename)
+
+def send_cached_image(file_name):
+	return send_from_directory(image_cache.directory_for(file_name), file_name, mimetype='image/gif')
+
+def format_stats(prefix, stats):
+	lines = []
+	for key, value in stats.items():
+		if isinstance(value, dict):
+			lines.extend(format_stats(f"{prefix}.{key}", value))
+		else:
+			lines.append(f"{prefix}.{key}: {value}")
+	return lines
+
+@app.route("/macproxy/stats")
+def serve_stats():
+	lines = format_stats("http_cache", get_http_cache_stats())
+	lines += format_stats("transcode_cache", get_transcode_cache_stats())
+	lines += format_stats("images", get_image_stats())
+	return Response("\n".join(lines) + "\n", mimetype='text/plain')
 
 def handle_image_request(url):
 	# Pass config values to fetch_and_cache_image
@@ -70,17 +142,17 @@ def handle_image_request(url):
 		dithering=config.DITHERING_ALGORITHM
 	)
 	if cached_url:
-		return send_from_directory(CACHE_DIR, os.path.basename(cached_url), mimetype='image/gif')
+		return send_cached_image(os.path.basename(cached_url))
 	else:
 		return abort(404, "Image not found or could not be processed")
 
 @app.route("/", defaults={"path": "/"}, methods=["GET", "POST"])
 @app.route("/<path:path>", methods=["GET", "POST"])
 def handle_request(path):
-	global override_extension
 	parsed_url = urlparse(request.url)
 	scheme = parsed_url.scheme
 	host = parsed_url.netloc.split(':')[0]  # Remove port if present
+	override_extension = proxy_state.get('override_extension')
 	
 	if override_extension:
 		print(f'Current override extension: {override_extension}')
@@ -101,7 +173,7 @@ def handle_request(path):
 	return handle_default_request()
 
 def handle_override_extension(scheme):
-	global override_extension
+	override_extension = proxy_state.get('override_extension')
 	if override_extension:
 		extension_name = override_extension.split('.')[-1]
 		if extension_name in extensions:
@@ -113,13 +185,12 @@ def handle_override_extension(scheme):
 				print(f"Warning: Unsupported scheme '{scheme}' for override extension.")
 		else:
 			print(f"Warning: Override extension '{extension_name}' not found. Resetting override.")
-			override_extension = None
+			proxy_state.delete('override_extension')
 	return None  # Return None if no override is active
 
 def check_override_status(extension_name):
-	global override_extension
 	if hasattr(extensions[extension_name], 'get_override_status') and not extensions[extension_name].get_override_status():
-		override_extension = None
+		proxy_state.delete('override_extension')
 		print("Override disabled")
 
 def find_matching_extension(host):
@@ -129,17 +200,19 @@ def find_matching_extension(host):
 	return None
 
 def handle_matching_extension(matching_extension):
-	global override_extension
 	print(f"Handling request with matching extension: {matching_extension.__name__}")
 	response = matching_extension.handle_request(request)
 	
 	if hasattr(matching_extension, 'get_override_status') and matching_extension.get_override_status():
-		override_extension = matching_extension.__name__
-		print(f"Override enabled for {override_extension}")
+		proxy_state.set('override_extension', matching_extension.__name__)
+		print(f"Override enabled for {matching_extension.__name__}")
 	
 	return response
 
 def process_response(response, url):
+	# Extensions return a Response, or content with an optional status code
+	# and headers. HTML content can be bytes, a str, or the BeautifulSoup
+	# tree the extension built, which is transcoded without reparsing it.
 	print(f"Processing response for URL: {url}")
 
 	if isinstance(response, tuple):
@@ -175,44 +248,21 @@ def process_response(response, url):
 			dithering=config.DITHERING_ALGORITHM
 		)
 		if cached_url:
-			return send_from_directory(CACHE_DIR, os.path.basename(cached_url), mimetype='image/gif')
+			return send_cached_image(os.path.basename(cached_url))
 		else:
 			return abort(404, "Image could not be processed")
 
 	# Handle CSS and JavaScript
-	if content_type in ['text/css', 'text/javascript', 'application/javascript', 'application/x-javascript']:
+	if is_script_or_style_type(content_type):
 		content = transcode_content(content)
 		response = Response(content, status_code)
 		response.headers['Content-Type'] = content_type
 		return response
 
-	# List of content types that should not be transcoded
-	non_transcode_types = [
-		'application/octet-stream',
-		'application/pdf',
-		'application/zip',
-		'application/x-zip-compressed',
-		'application/x-rar-compressed',
-		'application/x-tar',
-		'application/x-gzip',
-		'application/x-bzip2',
-		'application/x-7z-compressed',
-		'application/vnd.openxmlformats-officedocument',
-		'application/vnd.ms-excel',
-		'application/vnd.ms-powerpoint',
-		'application/msword',
-		'audio/',
-		'video/',
-		'text/plain'
-	]
-
-	# Check if content type is in the list of non-transcode types
-	should_transcode = not any(content_type.startswith(t) for t in non_transcode_types)
+	should_transcode = not is_passthrough_type(content_type)
 
 	if should_transcode:
 		print("Transcoding content")
-		if isinstance(content, bytes):
-			content = content.decode('utf-8', errors='replace')
 		content = transcode_html(
 			content,
 			url,
@@ -222,14 +272,20 @@ def process_response(response, url):
 			tags_to_strip=config.TAGS_TO_STRIP,
 			attributes_to_strip=config.ATTRIBUTES_TO_STRIP,
 			convert_characters=config.CONVERT_CHARACTERS,
-			conversion_table=config.CONVERSION_TABLE
+			conversion_table=config.CONVERSION_TABLE,
+			charset=charset_from_content_type(content_type)
 		)
 	else:
 		print(f"Content type {content_type} should not be transcoded, passing through unchanged")
+		if isinstance(content, BeautifulSoup):
+			content = str(content)
 
 	response = Response(content, status_code)
 	for key, value in headers.items():
 		if key.lower() not in ['content-encoding', 'content-length']:
+			if should_transcode and key.lower() == 'content-type':
+				# The transcoded page is re-encoded, whatever the site sent
+				value = set_charset(value, OUTPUT_ENCODING)
 			response.headers[key] = value
 
 	print("Finished processing response")
@@ -241,16 +297,119 @@ def handle_default_request():
 	
 	print(f"Handling default request for URL: {url}")
 	
+	if is_stripped_asset(url):
+		return skip_asset(url)
+
 	try:
+		# Only the headers have been read at this point, so large downloads
+		# can be relayed without holding the whole body in memory.
 		resp = send_request(url, headers)
-		content = resp.content
+		content_type = resp.headers.get('Content-Type', '').lower()
+		if is_passthrough_type(content_type):
+			return stream_response(resp)
+		if is_script_or_style_type(content_type):
+			return stream_rewritten_response(resp, content_type)
+		if STREAM_HTML and content_type.startswith('text/html'):
+			return stream_transcoded_response(resp, url)
+		# Images are refused once they're known to be too big, before they've all arrived
+		content = read_image(resp) if content_type.startswith('image/') else resp.content
 		status_code = resp.status_code
 		headers = dict(resp.headers)
 		return process_response((content, status_code, headers), url)
+	except ImageTooLarge as e:
+		print(f"Refusing image {url}: {str(e)}")
+		return abort(404, "Image is too large to be processed")
 	except Exception as e:
 		print(f"Error in handle_default_request: {str(e)}")
 		return abort(500, ERROR_HEADER + str(e))
 
+def is_passthrough_type(content_type):
+	return any(content_type.startswith(t) for t in NON_TRANSCODE_TYPES)
+
+def is_script_or_style_type(content_type):
+	return content_type.split(';')[0].strip() in SCRIPT_AND_STYLE_TYPES
+
+def is_stripped_asset(url):
+	"""
+	Whether a script or stylesheet was stripped from the page asking for it
+	(going by the Referer), so the browser can't use it anyway. Anything
+	else, including requests without a Referer, is fetched as usual.
+	"""
+	referer = request.headers.get('Referer')
+	return request.method == 'GET' and bool(referer) and was_stripped(url, referer)
+
+def skip_asset(url):
+	print(f"{url} was stripped from the page that refers to it, not downloading it")
+	return Response(status=204)
+
+def stream_rewritten_response(resp, content_type):
+	print(f"Rewriting {content_type} content as it arrives")
+
+	def generate():
+		try:
+			yield from transcode_content_stream(resp.iter_content(chunk_size=STREAM_CHUNK_SIZE))
+		finally:
+			resp.close()
+
+	response = Response(generate(), resp.status_code)
+	for key, value in resp.headers.items():
+		if key.lower() not in HOP_BY_HOP_HEADERS:
+			response.headers[key] = value
+	return response
+
+def stream_response(resp):
+	print(f"Content type {resp.headers.get('Content-Type')} should not be transcoded, streaming through unchanged")
+
+	def generate():
+		try:
+			for chunk in resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+				yield chunk
+		finally:
+			resp.close()
+
+	response = Response(generate(), resp.status_code)
+	for key, value in resp.headers.items():
+		if key.lower() not in HOP_BY_HOP_HEADERS:
+			response.headers[key] = value
+
+	# requests undoes any Content-Encoding, so the upstream length is only
+	# accurate for unencoded bodies. Keeping it lets old browsers show progress.
+	if 'Content-Length' in resp.headers and resp.headers.get('Content-Encoding', 'identity') == 'identity':
+		response.headers['Content-Length'] = resp.headers['Content-Length']
+	return response
+
+def stream_transcoded_response(resp, url):
+	print("Transcoding content as it arrives")
+
+	def generate():
+		try:
+			yield from stream_transcode_html(
+				resp.iter_content(chunk_size=STREAM_HTML_CHUNK_SIZE),
+				url,
+				whitelisted_domains=config.WHITELISTED_DOMAINS,
+				simplify_html=config.SIMPLIFY_HTML,
+				tags_to_unwrap=config.TAGS_TO_UNWRAP,
+				tags_to_strip=config.TAGS_TO_STRIP,
+				attributes_to_strip=config.ATTRIBUTES_TO_STRIP,
+				convert_characters=config.CONVERT_CHARACTERS,
+				conversion_table=config.CONVERSION_TABLE,
+				charset=charset_from_content_type(resp.headers.get('Content-Type'))
+			)
+		except Exception as e:
+			# The status line has already been sent, so all we can do is stop
+			print(f"Error while streaming {url}: {str(e)}")
+		finally:
+			resp.close()
+
+	# Inline SVGs are converted while streaming, which needs the request context
+	response = Response(stream_with_context(generate()), resp.status_code)
+	for key, value in resp.headers.items():
+		if key.lower() not in HOP_BY_HOP_HEADERS:
+			if key.lower() == 'content-type':
+				value = set_charset(value, OUTPUT_ENCODING)
+			response.headers[key] = value
+	return response
+
 def prepare_headers():
 	headers = {
 		"Accept": request.headers.get("Accept"),
@@ -263,9 +422,9 @@ def prepare_headers():
 def send_request(url, headers):
 	print(f"Sending request to: {url}")
 	if request.method == "POST":
-		return session.post(url, data=request.form, headers=headers, allow_redirects=True)
+		return session.post(url, data=request.form, headers=headers, allow_redirects=True, stream=True)
 	else:
-		return session.get(url, params=request.args, headers=headers)
+		return session.get(url, params=request.args, headers=headers, stream=True)
 
 @app.after_request
 def apply_caching(resp):
@@ -273,7 +432,14 @@ def apply_caching(resp):
 		resp.headers["Content-Type"] = g.content_type
 	except:
 		pass
-	return resp
+	return attach_client_cookie(resp)
+
+def split_memory_caches(workers):
+	# Forked workers each fill their own copy of the in-memory caches, so
+	# each gets its share of the configured budget
+	for cache in (http_cache.memory, transcode_cache):
+		if cache.max_bytes:
+			cache.max_bytes = max(1, cache.max_bytes // workers)
 
 def get_proxy_hostname(hostname):
 	# Based on the `log_startup` function from werkzeug.serving.
@@ -303,7 +469,45 @@ if __name__ == "__main__":
 		action="store",
 		help="Port number the web server will run on",
 	)
+	parser.add_argument(
+		"--server",
+		type=str,
+		default="development",
+		choices=["development", "production"],
+		action="store",
+		help="Use the Werkzeug development server, or the built-in production server",
+	)
+	parser.add_argument(
+		"--threads",
+		type=int,
+		default=8,
+		action="store",
+		help="Number of worker threads (production server only)",
+	)
+	parser.add_argument(
+		"--workers",
+		type=int,
+		default=1,
+		action="store",
+		help="Number of worker processes to fork (production server only)",
+	)
+	parser.add_argument(
+		"--max-pending",
+		type=int,
+		default=64,
+		action="store",
+		help="Connections allowed to wait for a free worker before new ones get a 503 (production server only)",
+	)
+	parser.add_argument(
+		"--shutdown-timeout",
+		type=int,
+		default=30,
+		action="store",
+		help="Seconds to wait for in-flight requests when shutting down (production server only)",
+	)
 	arguments = parser.parse_args()
+	if arguments.workers > 1 and arguments.server != "production":
+		parser.error("--workers requires --server production")
 
 	# Translate the bind address (typically 0.0.0.0 or ::) to a friendly
 	# hostname / IP, and store it and the port in the application config
@@ -311,4 +515,33 @@ if __name__ == "__main__":
 	# in the HTML (as opposed to the site we are proxying the request to).
 	app.config['MACPROXY_HOST_AND_PORT'] = f"{get_proxy_hostname(arguments.host)}:{arguments.port}"
 
-	app.run(host=arguments.host, port=arguments.port, debug=False)
+	if arguments.server == "production" and arguments.workers > 1:
+		# Override and extension state must be visible to every worker
+		if not is_shared_backend():
+			use_shared_backend(os.path.join(tempfile.gettempdir(), f"macproxy_state_{arguments.port}.sqlite"))
+		split_memory_caches(arguments.workers)
+		serve_prefork(
+			app,
+			arguments.host,
+			arguments.port,
+			workers=arguments.workers,
+			threads=arguments.threads,
+			max_pending=arguments.max_pending,
+			shutdown_timeout=arguments.shutdown_timeout,
+			on_worker_start=start_worker_pools,
+			on_worker_exit=stop_worker_pools
+		)
+	elif arguments.server == "production":
+		start_worker_pools()
+		serve_production(
+			app,
+			arguments.host,
+			arguments.port,
+			threads=arguments.threads,
+			max_pending=arguments.max_pending,
+			shutdown_timeout=arguments.shutdown_timeout
+		)
+	else:
+		os.environ['FLASK_ENV'] = 'development'
+		start_worker_pools()
+		app.run(host=arguments.host, port=arguments.port, debug=False)
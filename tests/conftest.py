@@ -0,0 +1,18 @@
+# Standard library imports
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+sys.path.insert(0, ROOT)
+
+# The tests run against the example settings, whatever config.py says, so
+# they don't depend on which extensions or preset a checkout has enabled
+loader = importlib.machinery.SourceFileLoader("config", os.path.join(ROOT, "config.py.example"))
+spec = importlib.util.spec_from_loader("config", loader)
+config = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(config)
+sys.modules["config"] = config
@@ -0,0 +1,22 @@
+# Third-party imports
+from PIL import Image
+
+# First-party imports
+from utils.dither_utils import reduce_colors
+from utils.image_utils import conversion_settings
+
+def test_unknown_settings_are_resolved_and_warned_about_once(capsys):
+	settings = conversion_settings(color_mode="gray3", dithering="sierra")
+	assert settings["color_mode"] == "BLACK_AND_WHITE"
+	assert settings["dithering"] == "THRESHOLD"
+	conversion_settings(color_mode="gray3", dithering="sierra")
+	img = Image.new("RGB", (8, 8), (200, 100, 50))
+	reduce_colors(img, "gray3", "sierra")
+	output = capsys.readouterr().out
+	assert output.count("Unknown image color mode gray3") == 1
+	assert output.count("Unknown dithering algorithm sierra") == 1
+
+def test_known_settings_are_upper_cased():
+	settings = conversion_settings(color_mode="gray16", dithering="atkinson")
+	assert (settings["color_mode"], settings["dithering"]) == ("GRAY16", "ATKINSON")
+	assert conversion_settings(dithering=None)["dithering"] == "THRESHOLD"
@@ -0,0 +1,62 @@
+# Standard library imports
+import glob
+import importlib.util
+import os
+import re
+
+# Third-party imports
+import pytest
+
+# First-party imports
+from conftest import FIXTURES
+from utils import html_utils
+
+PAGES = sorted(glob.glob(os.path.join(FIXTURES, "pages", "*.html")))
+
+# Pages that lxml is known to parse differently from html5lib, see HTML_PARSER in config.py.example
+KNOWN_DIFFERENCES = {
+	"headless.html": "lxml doesn't add the implied <head>",
+	"table.html": "lxml doesn't add the implied <tbody>",
+	"misnested.html": "lxml closes misnested formatting tags instead of reopening them",
+}
+
+def transcode(source, parser, monkeypatch):
+	monkeypatch.setattr(html_utils, "HTML_PARSER", parser)
+	result = html_utils.transcode_html_uncached(
+		source,
+		"http://example.org/",
+		whitelisted_domains=[],
+		simplify_html=True,
+		tags_to_unwrap=["noscript"],
+		tags_to_strip=["script", "link", "style", "source"],
+		attributes_to_strip=["style", "onclick", "class", "bgcolor"],
+		charset="utf-8",
+	)
+	# Whitespace between tags, and a newline after <pre> (which browsers skip), don't matter
+	return re.sub(rb">\s+<", b"><", result.replace(b"<pre>\n", b"<pre>")).strip()
+
+def page_param(path):
+	name = os.path.basename(path)
+	marks = [pytest.mark.xfail(reason=KNOWN_DIFFERENCES[name], strict=True)] if name in KNOWN_DIFFERENCES else []
+	return pytest.param(path, id=name, marks=marks)
+
+@pytest.mark.skipif(not html_utils.LXML_AVAILABLE, reason="lxml isn't installed")
+@pytest.mark.parametrize("path", [page_param(path) for path in PAGES])
+def test_lxml_matches_html5lib(path, monkeypatch):
+	with open(path, "rb") as f:
+		source = f.read()
+	assert transcode(source, "lxml", monkeypatch) == transcode(source, "html5lib", monkeypatch)
+
+@pytest.mark.parametrize("source", [b"<p>Plain page</p>", b"<p>Icon <svg viewBox='0 0 1 1'></svg></p>"])
+def test_auto_uses_html5lib_for_foreign_content(source, monkeypatch):
+	monkeypatch.setattr(html_utils, "HTML_PARSER", "auto")
+	expected = "html5lib" if b"<svg" in source or not html_utils.LXML_AVAILABLE else "lxml"
+	assert html_utils.choose_parser(source.decode()) == expected
+
+def test_html5lib_is_the_default(monkeypatch):
+	# A fresh copy of html_utils, loaded as if config.py didn't set HTML_PARSER
+	monkeypatch.delattr(html_utils.config, "HTML_PARSER", raising=False)
+	spec = importlib.util.spec_from_file_location("html_utils_without_setting", html_utils.__file__)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	assert module.choose_parser("<p>Plain page</p>") == "html5lib"
@@ -0,0 +1,102 @@
+# Standard library imports
+import io
+import os
+import pickle
+
+# Third-party imports
+import pytest
+from PIL import Image, JpegImagePlugin
+
+# First-party imports
+from utils import image_utils
+from utils.image_cache import ImageCache
+from utils.image_utils import optimize_image
+
+@pytest.fixture(scope="module")
+def large_jpeg():
+	img = Image.linear_gradient("L").resize((4000, 3000)).convert("RGB")
+	output = io.BytesIO()
+	img.save(output, "JPEG", quality=85)
+	return output.getvalue()
+
+@pytest.fixture
+def drafted_sizes(monkeypatch):
+	"""
+	Sizes JPEGs are decoded at, after optimize_image() asked for a draft
+	"""
+	sizes = []
+	draft = JpegImagePlugin.JpegImageFile.draft
+
+	def record_draft(self, mode, size):
+		result = draft(self, mode, size)
+		sizes.append(self.size)
+		return result
+
+	monkeypatch.setattr(JpegImagePlugin.JpegImageFile, "draft", record_draft)
+	return sizes
+
+@pytest.mark.parametrize("resize_quality", ["fast", "balanced"])
+def test_large_jpeg_is_decoded_at_reduced_scale(large_jpeg, drafted_sizes, resize_quality):
+	output = optimize_image(large_jpeg, convert_to="png", resize_quality=resize_quality)
+	assert len(drafted_sizes) == 1
+	width, height = drafted_sizes[0]
+	assert width < 4000 and height < 3000
+	assert width >= 456 and height >= 342
+	assert Image.open(io.BytesIO(output)).size == (456, 342)
+
+def test_best_quality_decodes_at_full_scale(large_jpeg, drafted_sizes):
+	output = optimize_image(large_jpeg, convert_to="png", resize_quality="best")
+	assert drafted_sizes == []
+	assert Image.open(io.BytesIO(output)).size == (456, 342)
+
+@pytest.mark.parametrize("skia_available, inkscape_path, expected", [
+	(True, "/usr/bin/inkscape", "skia"),
+	(True, None, "skia"),
+	(False, "/usr/bin/inkscape", "inkscape"),
+	(False, None, "skia"),
+])
+def test_auto_svg_renderer_prefers_skia(monkeypatch, skia_available, inkscape_path, expected):
+	monkeypatch.setattr(image_utils, "SVG_RENDERER", "auto")
+	monkeypatch.setattr(image_utils, "skia", object() if skia_available else None)
+	monkeypatch.setattr(image_utils.shutil, "which", lambda name: inkscape_path)
+	assert image_utils.get_svg_renderer() == expected
+
+def test_inkscape_can_be_chosen_explicitly(monkeypatch):
+	monkeypatch.setattr(image_utils, "SVG_RENDERER", "inkscape")
+	assert image_utils.get_svg_renderer() == "inkscape"
+
+@pytest.fixture
+def spool_cache(tmp_path, monkeypatch):
+	cache = ImageCache(cache_dir=str(tmp_path / "cache"))
+	monkeypatch.setattr(image_utils, "image_cache", cache)
+	return cache
+
+def spool(cache, name, link_to=None):
+	path = cache.path_for(name) + image_utils.PENDING_SUFFIX
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	if link_to:
+		os.symlink(link_to, path)
+	else:
+		with open(path, "wb") as f:
+			f.write(pickle.dumps((b"image", {"convert": False, "resize": False})))
+	return path
+
+def test_spooled_image_is_converted(spool_cache):
+	name = "0123456789abcdef0123456789abcdef-01234567.gif"
+	spool(spool_cache, name)
+	image_utils.convert_pending_image(name)
+	with open(spool_cache.path_for(name), "rb") as f:
+		assert f.read() == b"image"
+
+def test_symlinked_spool_is_not_loaded(spool_cache, tmp_path):
+	name = "0123456789abcdef0123456789abcdef-01234567.gif"
+	outside = tmp_path / "outside.pending"
+	outside.write_bytes(pickle.dumps((b"image", {"convert": False, "resize": False})))
+	path = spool(spool_cache, name, link_to=str(outside))
+	image_utils.convert_pending_image(name)
+	assert not spool_cache.contains(name)
+	assert os.path.islink(path)
+
+@pytest.mark.parametrize("name", ["../../outside.gif", "index.sqlite", "0123456789abcdef0123456789abcdef.gif"])
+def test_other_names_are_not_cached_image_names(name):
+	assert not image_utils.is_cached_image_name(name)
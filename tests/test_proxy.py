@@ -0,0 +1,77 @@
+# Standard library imports
+import io
+
+# Third-party imports
+import pytest
+import requests
+
+# First-party imports
+import proxy
+from utils import html_utils, image_utils
+
+def upstream_response(body, content_type, headers=None):
+	"""
+	A streamed response, as send_request() would return it
+	"""
+	response = requests.Response()
+	response.status_code = 200
+	response.headers["Content-Type"] = content_type
+	response.headers.update(headers or {})
+	response.raw = io.BytesIO(body)
+	return response
+
+@pytest.fixture
+def client():
+	proxy.app.config["MACPROXY_HOST_AND_PORT"] = "127.0.0.1:5001"
+	return proxy.app.test_client()
+
+@pytest.fixture
+def upstream(monkeypatch):
+	"""
+	Answers the proxy's upstream requests with the response set by the
+	test, and records which URLs were requested
+	"""
+	class Upstream:
+		response = None
+		requested = []
+
+	def send_request(url, headers):
+		Upstream.requested.append(url)
+		return Upstream.response
+
+	monkeypatch.setattr(proxy, "send_request", send_request)
+	return Upstream
+
+def test_stripped_asset_is_not_fetched(client, upstream):
+	html_utils.remember_stripped_assets("http://example.org/page.html", {"/app.js"})
+	response = client.get("http://example.org/app.js", headers={"Referer": "http://example.org/page.html"})
+	assert response.status_code == 204
+	assert upstream.requested == []
+
+@pytest.mark.parametrize("headers", [{}, {"Referer": "http://example.org/unrelated.html"}])
+def test_other_assets_are_fetched(client, upstream, headers):
+	html_utils.remember_stripped_assets("http://example.org/page.html", {"/app.js"})
+	upstream.response = upstream_response(b"load('https://example.org/more.js')", "application/javascript")
+	response = client.get("http://example.org/app.js", headers=headers)
+	assert response.status_code == 200
+	assert response.data == b"load('http://example.org/more.js')"
+
+@pytest.fixture
+def small_image_limit(monkeypatch):
+	monkeypatch.setattr(proxy, "read_image", lambda response: image_utils.read_image(response, max_bytes=1024))
+
+def test_image_with_oversized_content_length_is_refused(client, upstream, small_image_limit):
+	# The URL doesn't look like an image, so it goes through the default path
+	upstream.response = upstream_response(b"", "image/jpeg", {"Content-Length": "2048"})
+	response = client.get("http://example.org/photo?id=1")
+	assert response.status_code == 404
+
+def test_oversized_streamed_image_is_refused(client, upstream, small_image_limit):
+	upstream.response = upstream_response(b"\xff" * 4096, "image/jpeg")
+	response = client.get("http://example.org/photo?id=2")
+	assert response.status_code == 404
+
+@pytest.mark.parametrize("name", ["index.sqlite", "..", "0123456789abcdef0123456789abcdef-01234567.gif.pending"])
+def test_only_cached_image_names_are_served(client, name):
+	response = client.get(f"/cached_image/{name}")
+	assert response.status_code == 404
@@ -0,0 +1,40 @@
+# First-party imports
+from utils import html_utils, state_utils
+from utils.stream_utils import stream_transcode_html
+
+PAGE = b"""<html><head>
+<link rel="stylesheet" href="/style.css">
+<link rel="alternate" href="/feed.xml">
+<script src="https://cdn.example.com/app.js?v=2"></script>
+<script>inline()</script>
+</head><body><p>Text</p></body></html>"""
+
+def transcode(url):
+	return html_utils.transcode_html_uncached(PAGE, url, whitelisted_domains=["kept.example.org"],
+		simplify_html=True, tags_to_strip=["script", "link"], charset="utf-8")
+
+def test_stripped_scripts_and_stylesheets_are_recorded():
+	transcode("http://example.org/dir/page.html")
+	page = "http://example.org/dir/page.html?query"
+	assert html_utils.was_stripped("http://example.org/style.css", page)
+	assert html_utils.was_stripped("https://cdn.example.com/app.js", page)
+	# Only stylesheets are fetched for <link> tags
+	assert not html_utils.was_stripped("http://example.org/feed.xml", page)
+	assert not html_utils.was_stripped("http://example.org/style.css", "http://example.org/other.html")
+
+def test_whitelisted_pages_record_nothing():
+	transcode("http://kept.example.org/page.html")
+	assert not html_utils.was_stripped("http://kept.example.org/style.css", "http://kept.example.org/page.html")
+
+def test_streamed_pages_are_recorded():
+	b"".join(stream_transcode_html([PAGE[:40], PAGE[40:]], "http://example.org/streamed.html",
+		whitelisted_domains=[], simplify_html=True, tags_to_strip=["script", "link"]))
+	assert html_utils.was_stripped("http://example.org/style.css", "http://example.org/streamed.html")
+	assert html_utils.was_stripped("http://cdn.example.com/app.js", "http://example.org/streamed.html")
+
+def test_client_state_is_not_pushed_out(monkeypatch):
+	monkeypatch.setattr(state_utils, "backend", state_utils.MemoryBackend(max_entries=1))
+	state_utils.backend.set("override:global:override_active", True)
+	for i in range(3):
+		transcode(f"http://example.org/page{i}.html")
+	assert state_utils.backend.get("override:global:override_active") is True
@@ -0,0 +1,84 @@
+# Standard library imports
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+	"""
+	Thread-safe least-recently-used cache, bounded by number of entries
+	and/or total size. `sizeof` measures an entry when max_bytes is set
+	(defaults to len()). Tracks hits, misses and evictions.
+	"""
+
+	def __init__(self, max_entries=None, max_bytes=None, sizeof=len):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.sizeof = sizeof
+		self.entries = OrderedDict()
+		self.sizes = {}
+		self.total_bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, key):
+		with self.lock:
+			return key in self.entries
+
+	def get(self, key, default=None):
+		with self.lock:
+			if key in self.entries:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return self.entries[key]
+			self.misses += 1
+			return default
+
+	def set(self, key, value):
+		size = self.sizeof(value) if self.max_bytes else 0
+		with self.lock:
+			if key in self.entries:
+				self.remove(key)
+			# Never let one oversized entry flush the whole cache
+			if self.max_bytes and size > self.max_bytes:
+				return
+			self.entries[key] = value
+			self.sizes[key] = size
+			self.total_bytes += size
+			while ((self.max_entries and len(self.entries) > self.max_entries) or
+					(self.max_bytes and self.total_bytes > self.max_bytes)):
+				oldest = next(iter(self.entries))
+				self.remove(oldest)
+				self.evictions += 1
+
+	def delete(self, key):
+		with self.lock:
+			if key in self.entries:
+				self.remove(key)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.sizes.clear()
+			self.total_bytes = 0
+
+	def remove(self, key):
+		# Caller must hold the lock
+		del self.entries[key]
+		self.total_bytes -= self.sizes.pop(key)
+
+	def stats(self):
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {
+				"entries": len(self.entries),
+				"bytes": self.total_bytes,
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+				"hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+			}
@@ -0,0 +1,266 @@
+# Third-party imports
+import numpy
+from PIL import Image
+
+
+# Error diffusion kernels: (row offset, column offset, share of the error).
+# Atkinson only passes on 6/8 of the error, which keeps highlights and
+# shadows clean; it's the look of MacPaint and HyperCard.
+ATKINSON = (
+	(0, 1, 1 / 8), (0, 2, 1 / 8),
+	(1, -1, 1 / 8), (1, 0, 1 / 8), (1, 1, 1 / 8),
+	(2, 0, 1 / 8),
+)
+FLOYD_STEINBERG = (
+	(0, 1, 7 / 16),
+	(1, -1, 3 / 16), (1, 0, 5 / 16), (1, 1, 1 / 16),
+)
+
+# Color lookup tables map each color, at this many bits per channel, to its nearest palette entry
+LUT_BITS = 5
+
+def bayer_matrix(size):
+	"""
+	The size x size ordered dithering matrix, as thresholds between 0 and 1
+	"""
+	matrix = numpy.zeros((1, 1))
+	while matrix.shape[0] < size:
+		matrix = numpy.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+	return (matrix + 0.5) / matrix.size
+
+BAYER_MATRIX = bayer_matrix(8)
+
+def hex_colors(*values):
+	return [(value >> 16, (value >> 8) & 0xff, value & 0xff) for value in values]
+
+# The Macintosh 4-bit color palette
+MAC_16_COLORS = hex_colors(
+	0xffffff, 0xfcf305, 0xff6402, 0xdd0806, 0xf20884, 0x4600a5, 0x0000d4, 0x02abea,
+	0x1fb714, 0x006411, 0x562c05, 0x90713a, 0xc0c0c0, 0x808080, 0x404040, 0x000000,
+)
+
+def mac_256_colors():
+	"""
+	The Macintosh 8-bit system palette: a 6x6x6 color cube without black,
+	ramps of ten reds, greens, blues and grays, then black
+	"""
+	steps = (0xff, 0xcc, 0x99, 0x66, 0x33, 0x00)
+	ramp = (0xee, 0xdd, 0xbb, 0xaa, 0x88, 0x77, 0x55, 0x44, 0x22, 0x11)
+	colors = [(r, g, b) for r in steps for g in steps for b in steps][:-1]
+	colors += [(level, 0, 0) for level in ramp]
+	colors += [(0, level, 0) for level in ramp]
+	colors += [(0, 0, level) for level in ramp]
+	colors += [(level, level, level) for level in ramp]
+	return colors + [(0, 0, 0)]
+
+
+class Palette:
+	"""
+	A set of colors, with a lookup table from every color to the nearest of
+	them. The table is built once, then each image is mapped through it with
+	a single indexing operation.
+	"""
+
+	def __init__(self, colors):
+		self.colors = numpy.asarray(colors, dtype=numpy.float32)
+		self.channels = self.colors.shape[1]
+		# Typical distance between neighbouring colors, which ordered dithering spreads pixels over
+		self.spread = 255 / max(1, len(self.colors) ** (1 / self.channels) - 1)
+		self.lut = self.build_lut()
+		self.image = Image.new("P", (1, 1))
+		rgb = numpy.repeat(self.colors, 3 // self.channels, axis=1)
+		self.image.putpalette(rgb.astype(numpy.uint8).tobytes())
+
+	def build_lut(self):
+		shift = 8 - LUT_BITS
+		centers = (numpy.arange(1 << LUT_BITS) << shift).astype(numpy.float32) + (1 << shift) / 2
+		grid = numpy.stack(numpy.meshgrid(centers, centers, centers, indexing='ij'), axis=-1).reshape(-1, 3)
+		lut = numpy.empty(len(grid), dtype=numpy.uint8)
+		# |a - b|^2 = |a|^2 - 2ab + |b|^2, in slices to keep the distance matrix small
+		squares = (self.colors ** 2).sum(axis=1)
+		for start in range(0, len(grid), 4096):
+			part = grid[start:start + 4096]
+			distances = squares - 2 * part @ self.colors.T
+			lut[start:start + 4096] = distances.argmin(axis=1)
+		return lut.reshape((1 << LUT_BITS,) * 3)
+
+	def nearest(self, values):
+		"""
+		Palette indexes of the nearest colors to an array of (..., 3) colors
+		"""
+		channels = numpy.clip(values, 0, 255).astype(numpy.uint8) >> (8 - LUT_BITS)
+		return self.lut[channels[..., 0], channels[..., 1], channels[..., 2]]
+
+	def to_image(self, indexes):
+		img = Image.fromarray(indexes)
+		img.putpalette(self.image.getpalette())
+		return img
+
+class GrayLevels(Palette):
+	"""
+	`levels` evenly spaced grays, from black to white. The nearest one is
+	worked out directly, so it needs no lookup table.
+	"""
+
+	def __init__(self, levels):
+		self.levels = levels
+		super().__init__(numpy.linspace(0, 255, levels).reshape(-1, 1))
+
+	def build_lut(self):
+		return None
+
+	def nearest(self, values):
+		return numpy.rint(numpy.clip(values[..., 0], 0, 255) * ((self.levels - 1) / 255)).astype(numpy.uint8)
+
+	def to_image(self, indexes):
+		if self.levels == 2:
+			return Image.fromarray(indexes * numpy.uint8(255)).convert("1", dither=Image.Dither.NONE)
+		return super().to_image(indexes)
+
+
+def threshold(pixels, palette):
+	"""
+	Maps each pixel to the nearest color, and returns the palette indexes
+	"""
+	return palette.nearest(pixels)
+
+def ordered_dither(pixels, palette, matrix=BAYER_MATRIX):
+	"""
+	Dithers with a tiled threshold matrix. Every pixel is independent of the
+	others, so this is a handful of whole-array operations.
+	"""
+	height, width = pixels.shape[:2]
+	rows, columns = matrix.shape
+	thresholds = numpy.tile(matrix, (height // rows + 1, width // columns + 1))[:height, :width]
+	return palette.nearest(pixels + ((thresholds - 0.5) * palette.spread)[..., None])
+
+def error_diffusion(pixels, palette, kernel):
+	"""
+	Dithers by passing each pixel's rounding error on to the pixels after it.
+
+	A pixel only takes error from pixels to its left and in the rows above,
+	up to one column to its right. So when each row runs two columns behind
+	the one above it, all pixels on that diagonal are independent of each
+	other, and are rounded in one vectorized step: width + 2 * height steps
+	in all, rather than one per pixel.
+	"""
+	height, width, channels = pixels.shape
+	lag = 2
+	# Pad, so error that falls off an edge lands somewhere harmless
+	pad_left = max(0, -min(dx for _, dx, _ in kernel))
+	pad_right = max(dx for _, dx, _ in kernel)
+	pad_bottom = max(dy for dy, _, _ in kernel)
+	stride = width + pad_left + pad_right
+	work = numpy.zeros(((height + pad_bottom) * stride, channels), dtype=numpy.float32)
+	work.reshape(-1, stride, channels)[:height, pad_left:pad_left + width] = pixels
+	result = numpy.zeros(len(work), dtype=numpy.uint8)
+	offsets = [(dy * stride + dx, weight) for dy, dx, weight in kernel]
+
+	rows = numpy.arange(height)
+	for diagonal in range(width + lag * (height - 1)):
+		# Rows whose column `diagonal - lag * row` is inside the image
+		first = max(0, (diagonal - width) // lag + 1)
+		last = min(height - 1, diagonal // lag)
+		row = rows[first:last + 1]
+		index = row * stride + (diagonal - lag * row) + pad_left
+		values = work[index]
+		nearest = palette.nearest(values)
+		result[index] = nearest
+		error = values - palette.colors[nearest]
+		for offset, weight in offsets:
+			work[index + offset] += error * weight
+	return result.reshape(-1, stride)[:height, pad_left:pad_left + width]
+
+# Dithering algorithms by DITHERING_ALGORITHM name
+DITHERERS = {
+	"ATKINSON": lambda pixels, palette: error_diffusion(pixels, palette, ATKINSON),
+	"FLOYDSTEINBERG": lambda pixels, palette: error_diffusion(pixels, palette, FLOYD_STEINBERG),
+	"BAYER": ordered_dither,
+	"THRESHOLD": threshold,
+}
+
+# Fixed palettes by IMAGE_COLOR_MODE name. "ADAPTIVE" picks the best 256 colors for each image.
+COLOR_MODES = {
+	"BLACK_AND_WHITE": lambda: GrayLevels(2),
+	"GRAY4": lambda: GrayLevels(4),
+	"GRAY16": lambda: GrayLevels(16),
+	"GRAY256": lambda: GrayLevels(256),
+	"COLOR16": lambda: Palette(MAC_16_COLORS),
+	"COLOR256": lambda: Palette(mac_256_colors()),
+}
+ADAPTIVE_COLORS = 256
+
+# Palettes that have been built, by color mode
+palettes = {}
+
+# Unknown setting values that have already been warned about
+unknown_values = set()
+
+def warn_once(message):
+	if message not in unknown_values:
+		unknown_values.add(message)
+		print(message)
+
+def resolve_color_mode(color_mode):
+	"""
+	The name of an IMAGE_COLOR_MODE in upper case, or BLACK_AND_WHITE (with
+	a warning, the first time) if there's no such mode
+	"""
+	name = (color_mode or "BLACK_AND_WHITE").upper()
+	if name != "ADAPTIVE" and name not in COLOR_MODES:
+		warn_once(f"Unknown image color mode {color_mode}, using BLACK_AND_WHITE")
+		return "BLACK_AND_WHITE"
+	return name
+
+def resolve_dithering(algorithm):
+	"""
+	The name of a DITHERING_ALGORITHM in upper case. No algorithm means
+	THRESHOLD, and so does an unknown one (with a warning, the first time).
+	"""
+	name = (algorithm or "THRESHOLD").upper()
+	if name not in DITHERERS:
+		warn_once(f"Unknown dithering algorithm {algorithm}, using THRESHOLD")
+		return "THRESHOLD"
+	return name
+
+def get_palette(color_mode):
+	"""
+	The palette of a fixed IMAGE_COLOR_MODE, built the first time it's used
+	"""
+	palette = palettes.get(color_mode)
+	if palette is None:
+		palette = COLOR_MODES[color_mode]()
+		palettes[color_mode] = palette
+	return palette
+
+def reduce_colors(img, color_mode="BLACK_AND_WHITE", algorithm="FLOYDSTEINBERG"):
+	"""
+	Converts an RGB image to the colors of an IMAGE_COLOR_MODE, with the named
+	DITHERING_ALGORITHM. No algorithm means mapping each pixel to the nearest color.
+	Settings from conversion_settings() have already been resolved.
+	"""
+	color_mode = resolve_color_mode(color_mode)
+	name = resolve_dithering(algorithm)
+	ditherer = DITHERERS[name]
+
+	if color_mode == "ADAPTIVE":
+		# Octree quantization is many times faster than Pillow's default median cut
+		if name == "FLOYDSTEINBERG":
+			return img.quantize(ADAPTIVE_COLORS, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.FLOYDSTEINBERG)
+		colors = img.quantize(ADAPTIVE_COLORS, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE).getpalette()
+		palette = Palette(numpy.array(colors, dtype=numpy.uint8).reshape(-1, 3))
+	else:
+		palette = get_palette(color_mode)
+		# Pillow's own Floyd-Steinberg runs in C, and is faster still. Its
+		# palette lookup is approximate, which shows in grays but not in colors.
+		if name == "FLOYDSTEINBERG" and color_mode == "BLACK_AND_WHITE":
+			return img.convert("L").convert("1", dither=Image.Dither.FLOYDSTEINBERG)
+		if name == "FLOYDSTEINBERG" and palette.channels == 3:
+			return img.quantize(palette=palette.image, dither=Image.Dither.FLOYDSTEINBERG)
+		if color_mode == "GRAY256":
+			# Every gray is in the palette, so there's no error to spread
+			ditherer = threshold
+
+	source = img.convert("L") if palette.channels == 1 else img.convert("RGB")
+	pixels = numpy.asarray(source, dtype=numpy.float32).reshape(img.height, img.width, palette.channels)
+	return palette.to_image(ditherer(pixels, palette))
@@ -3,205 +3,677 @@ import copy
 import hashlib
 import html
 import re
+from urllib.parse import urljoin, urlparse
 
 # Third-party imports
-from bs4 import BeautifulSoup
-from bs4.formatter import HTMLFormatter
+from bs4 import BeautifulSoup, NavigableString, Tag
+from bs4.builder import builder_registry
 from flask import current_app, url_for
 
 # First-party imports
-from utils.image_utils import fetch_and_cache_image
+from utils.cache_utils import LRUCache
+from utils.image_utils import cached_image_name, conversion_settings, queue_image
+from utils.pool_utils import run_in_pool, use_transcode_pool
 from utils.system_utils import load_preset
+from utils.text_utils import OUTPUT_ENCODING, declare_charset, decode_html, get_transliterator
 
 # Get config
 config = load_preset()
 
+# Transcoded pages are remembered by content, host and settings, so an
+# unchanged page (e.g. after pressing Back) isn't parsed and transformed again
+TRANSCODE_CACHE_BYTES = getattr(config, 'TRANSCODE_CACHE_BYTES', 16 * 1024 * 1024)
+transcode_cache = LRUCache(max_bytes=TRANSCODE_CACHE_BYTES, sizeof=lambda entry: len(entry[0]) + sum(map(len, entry[1].values())) + sum(map(len, entry[2])))
 
-class URLAwareHTMLFormatter(HTMLFormatter):
-	def __init__(self, *args, **kwargs):
-		super().__init__(*args, **kwargs)
+# Scripts and stylesheets stripped from each page, by the page's host and path.
+# Kept apart from the state store, with a cap of its own, so browsing never
+# pushes out client state. Each worker process only knows the pages it transcoded.
+STRIPPED_ASSETS_MAX_PAGES = getattr(config, 'STRIPPED_ASSETS_MAX_PAGES', 1000)
+stripped_assets = LRUCache(max_entries=STRIPPED_ASSETS_MAX_PAGES)
 
-	def escape(self, string):
-		"""
-		Escape special characters in the given string or list of strings.
-		"""
-		if isinstance(string, list):
-			return [html.escape(str(item), quote=True) for item in string]
-		elif string is None:
-			return ''
-		else:
-			return html.escape(str(string), quote=True)
+# html5lib builds the same tree a browser would. "auto" parses with the much
+# faster lxml unless the page contains foreign content (inline SVG or MathML),
+# whose mixed-case tags and attributes only html5lib keeps. lxml's tree isn't
+# always the same: it leaves out the implied <head> and <tbody> elements, and
+# doesn't reopen formatting tags that are closed out of order, so
+# <font>a<b>b</font>c</b> loses the bold on "c". See tests/test_html_parsers.py.
+HTML_PARSER = getattr(config, 'HTML_PARSER', 'html5lib')
+FOREIGN_CONTENT_PATTERN = re.compile(r'<(?:svg|math)[\s/>]', re.IGNORECASE)
+LXML_AVAILABLE = builder_registry.lookup('lxml') is not None
+
+# Compiled transform pipelines, see get_pipeline()
+pipelines = {}
+
+# Pages that aren't simplified (SIMPLIFY_HTML = False, or a whitelisted domain)
+# only need their URLs rewritten, which is done on the source without parsing
+# it, unless they contain inline SVGs to rasterize
+HTML_FAST_PATH = getattr(config, 'HTML_FAST_PATH', True)
+SVG_TAG_PATTERN = re.compile(r'<svg[\s/>]', re.IGNORECASE)
+
+# Start tags whose attributes the fast path may rewrite, and <style> elements
+SOURCE_TAG_PATTERN = re.compile(r'''<(link|script|img|a|iframe|meta)(?=[\s/>])(?:[^>"']|"[^"]*"|'[^']*')*>''', re.IGNORECASE)
+SOURCE_ATTR_PATTERN = re.compile(r'''(\s([^\s"'>/=]+)\s*=\s*)("[^"]*"|'[^']*'|[^\s"'>]+)''')
+SOURCE_STYLE_PATTERN = re.compile(r'(<style(?=[\s>])[^>]*>)(.*?)(</style\s*>)', re.IGNORECASE | re.DOTALL)
 
-	def attributes(self, tag):
-		for key, val in tag.attrs.items():
-			if key in ['href', 'src']:  # Don't escape URL attributes
-				yield key, val
+
+# Attribute values containing none of these are written without escaping
+ATTRIBUTE_ESCAPE_PATTERN = re.compile(r'''[&<>"']''')
+
+def format_start_tag(name, attrs):
+	"""
+	Writes <name attr="value" ...>. URL attributes (href, src) are written
+	as they are, everything else is escaped. Void elements never get a
+	trailing slash, which HTML 3.2 browsers don't expect.
+	"""
+	parts = ['<', name]
+	for key, val in attrs:
+		if val is None:
+			parts += (' ', key)
+			continue
+		if isinstance(val, (list, tuple)):
+			val = ' '.join(val)
+		elif not isinstance(val, str):
+			val = str(val)
+		quote = '"'
+		if key not in ('href', 'src'):  # Don't escape URL attributes
+			if ATTRIBUTE_ESCAPE_PATTERN.search(val):
+				val = html.escape(val, quote=True)
+		elif '"' in val:
+			if "'" in val:
+				val = val.replace('"', '&quot;')
 			else:
-				yield key, self.escape(val)
+				quote = "'"
+		parts += (' ', key, '=', quote, val, quote)
+	parts.append('>')
+	return ''.join(parts)
+
+def serialize_html(soup, encoding=OUTPUT_ENCODING):
+	"""
+	Writes out a parsed page, encoded once at the end. Text is written as it
+	is, without entity substitution, as the transcoder always has. Characters
+	the encoding can't represent are written as character references.
+	"""
+	parts = []
+	append = parts.append
+	stack = [iter(soup.contents)]
+	end_tags = [None]
+	while stack:
+		node = next(stack[-1], None)
+		if node is None:
+			stack.pop()
+			end_tag = end_tags.pop()
+			if end_tag:
+				append(end_tag)
+			continue
+		if not isinstance(node, Tag):
+			# Comments, doctypes etc. add their own <!-- --> and the like
+			append(node.PREFIX + node + node.SUFFIX)
+			continue
+		name = f"{node.prefix}:{node.name}" if node.prefix else node.name
+		if not node.hidden:
+			attrs = declare_charset(node.attrs, encoding) if name == 'meta' else node.attrs
+			append(format_start_tag(name, attrs.items()))
+		if node.is_empty_element:
+			continue
+		stack.append(iter(node.contents))
+		end_tags.append(None if node.hidden else f"</{name}>")
+	return ''.join(parts).encode(encoding, errors='xmlcharrefreplace')
+
+def prefix_pattern(literal):
+	"""
+	Regex matching any non-empty prefix of `literal`, e.g. "h(?:t(?:t)?)?"
+	"""
+	pattern = b''
+	for byte in reversed(literal):
+		pattern = re.escape(bytes([byte])) + (b'(?:' + pattern + b')?' if pattern else b'')
+	return pattern
+
+# CSS url() holding an https URL, which loses its quotes when rewritten,
+# e.g. url("https://x") -> url(http://x)
+CSS_URL_PATTERN = re.compile(rb"""url\(['"]?(https://[^)'"]+)['"]?\)""")
+
+# Matches the end of a chunk that may be the start of a reference continuing
+# in the next chunk: an unfinished url(), or part of "https://"
+CONTENT_TAIL_PATTERN = re.compile(
+	rb"(?:" + prefix_pattern(b"url(") +
+	rb"""|url\(['"]?(?:""" + prefix_pattern(b"https://") + rb""")?""" +
+	rb"""|url\(['"]?https://[^)'"]*['"]?""" +
+	rb"|" + prefix_pattern(b"https://") + rb")\Z"
+)
+
+# An unfinished url() longer than this (e.g. an inline data: URI) is not held back
+CONTENT_HOLDBACK_BYTES = 64 * 1024
 
 def transcode_content(content):
 	"""
 	Convert HTTPS to HTTP in CSS or JavaScript content
 	"""
-	if isinstance(content, bytes):
-		content = content.decode('utf-8', errors='replace')
-		
-	# Simple pattern to match URLs in both CSS and JS
-	patterns = [
-		(r"""url\(['"]?(https://[^)'"]+)['"]?\)""", r"url(\1)"),  # CSS url()
-		(r'"https://', '"http://'),  # Double-quoted URLs
-		(r"'https://", "'http://"),  # Single-quoted URLs
-		(r"https://", "http://"),    # Unquoted URLs
-	]
-	
-	for pattern, replacement in patterns:
-		content = re.sub(pattern, 
-						lambda m: replacement.replace(r"\1", 
-						m.group(1).replace("https://", "http://") if len(m.groups()) > 0 else ""),
-						content)
-	
-	return content.encode('utf-8')
+	if isinstance(content, str):
+		content = content.encode('utf-8')
+	# The url() pattern starts with a literal, so the regex engine skips
+	# ahead quickly, and bytes.replace() takes care of every other reference
+	return CSS_URL_PATTERN.sub(rb"url(\1)", content).replace(b"https://", b"http://")
+
+def content_cut(pending):
+	"""
+	Where to split buffered CSS or JavaScript, so that no reference is cut in two
+	"""
+	# An unfinished url() can't contain a closing parenthesis
+	start = max(0, len(pending) - CONTENT_HOLDBACK_BYTES, pending.rfind(b")") + 1)
+	start = pending.find(b"url(", start)
+	while start != -1:
+		if CONTENT_TAIL_PATTERN.match(pending, start):
+			return start
+		start = pending.find(b"url(", start + 1)
+	tail = CONTENT_TAIL_PATTERN.search(pending, max(0, len(pending) - 16))
+	return tail.start() if tail else len(pending)
+
+def transcode_content_stream(chunks):
+	"""
+	Like transcode_content(), for an iterable of byte chunks. Yields rewritten
+	chunks as soon as they can't be part of a reference that continues in a
+	later chunk.
+	"""
+	pending = b''
+	for chunk in chunks:
+		pending += chunk
+		cut = content_cut(pending)
+		if cut:
+			yield transcode_content(pending[:cut])
+			pending = pending[cut:]
+	if pending:
+		yield transcode_content(pending)
+
+def get_transcode_cache_stats():
+	return transcode_cache.stats()
 
 def transcode_html(html, url=None, whitelisted_domains=None, simplify_html=False, 
 				  tags_to_unwrap=None, tags_to_strip=None, attributes_to_strip=None,
-				  convert_characters=False, conversion_table=None):
+				  convert_characters=False, conversion_table=None, charset=None):
 	"""
-	Uses BeautifulSoup to transcode payloads of the text/html content type
+	Returns the transcoded page from the memo cache if this exact input was
+	already transcoded for the same host with the same settings.
+
+	The page can be given as the bytes the upstream server sent, along with
+	the charset its Content-Type header declared, and is only decoded if
+	it has to be transcoded. Trees that extensions built are never cached,
+	as they can't be hashed without serializing them first.
+	"""
+	if not TRANSCODE_CACHE_BYTES or isinstance(html, BeautifulSoup):
+		return transcode_html_uncached(html, url, whitelisted_domains, simplify_html, tags_to_unwrap,
+			tags_to_strip, attributes_to_strip, convert_characters, conversion_table, charset)
+
+	html_bytes = html.encode('utf-8', errors='surrogatepass') if isinstance(html, str) else html
+	host = urlparse(url).netloc if url else ''
+	settings = (
+		charset, whitelisted_domains, simplify_html, tags_to_unwrap, tags_to_strip, attributes_to_strip,
+		convert_characters, conversion_table,
+		# Inline SVGs are replaced with <img> tags that point back at the proxy
+		get_svg_image_settings(),
+		current_app.config.get('MACPROXY_HOST_AND_PORT'),
+	)
+	key = (
+		hashlib.sha256(html_bytes).hexdigest(),
+		host,
+		hashlib.sha256(repr(settings).encode()).hexdigest(),
+	)
+
+	cached = transcode_cache.get(key)
+	if cached is not None:
+		print("Using memoized transcode output")
+		result, svg_images, stripped = cached
+		# The page refers to converted inline SVGs, which may have been evicted since
+		for fake_url, svg_source in svg_images.items():
+			queue_svg_image(fake_url, svg_source)
+		# The same page may be at another path on this host
+		remember_stripped_assets(url, stripped)
+		return result
+
+	result, svg_images, stripped = transcode_page(html, url, whitelisted_domains, simplify_html, tags_to_unwrap,
+		tags_to_strip, attributes_to_strip, convert_characters, conversion_table, charset)
+	transcode_cache.set(key, (result, svg_images, stripped))
+	return result
+
+def asset_key(url):
+	# Scheme, query and fragment are left out: pages are fetched over HTTP, whatever they link to
+	parts = urlparse(url)
+	return parts.netloc.lower() + (parts.path or '/')
+
+def remember_stripped_assets(url, stripped):
+	"""
+	Records the scripts and stylesheets stripped from the page at `url`,
+	given as they appeared in its src and href attributes
+	"""
+	if url and stripped:
+		stripped_assets.set(asset_key(url), frozenset(asset_key(urljoin(url, asset)) for asset in stripped))
+
+def was_stripped(asset_url, page_url):
+	"""
+	Whether the page at `page_url` referred to `asset_url` in a <script> or
+	<link> tag that was stripped
+	"""
+	return asset_key(asset_url) in stripped_assets.get(asset_key(page_url), ())
+
+def is_stylesheet_link(tag, rel):
+	# rel is a list in trees bs4 built, and a str in the streaming transcoder
+	return tag == 'link' and 'stylesheet' in (rel.lower().split() if isinstance(rel, str) else rel or ())
+
+def choose_parser(html):
+	if HTML_PARSER != 'auto':
+		return HTML_PARSER
+	if LXML_AVAILABLE and not FOREIGN_CONTENT_PATTERN.search(html):
+		return 'lxml'
+	return 'html5lib'
+
+class TranscodeRule:
+	"""
+	A single transform applied to matching tags during the pipeline's one
+	traversal of the tree. `tags` limits the rule to those tag names (None
+	matches every tag), and `attrs` skips tags carrying none of those
+	attributes. `apply(tag, context)` returns None to leave the tag in the
+	tree, or a list of the nodes to visit in its place once it was removed.
+	"""
+
+	def __init__(self, apply, tags=None, attrs=None):
+		self.apply = apply
+		self.tags = frozenset(tags) if tags is not None else None
+		self.attrs = frozenset(attrs) if attrs is not None else None
+
+class TranscodeContext:
+	"""
+	What the traversal collects for the steps that need the finished tree:
+	<use> and <svg> tags, and <symbol> tags by id. Also the source of each
+	distinct SVG queued for conversion, by name, where the converted images
+	are served from (looked up from the app if not given), and the URLs of
+	stripped scripts and stylesheets.
+	"""
+
+	def __init__(self):
+		self.use_tags = []
+		self.svg_tags = []
+		self.symbols = {}
+		self.svg_images = {}
+		self.stripped_assets = set()
+		self.image_base_url = None
+		# Worker processes leave queueing the images to the request thread
+		self.queue_images = True
+
+class TranscodePipeline:
+	"""
+	Rules in the order they are applied to each tag. A tag name's rules are
+	looked up once, so visiting a node only costs the rules that match it.
 	"""
 
-	if isinstance(html, bytes):
-		html = html.decode("utf-8", errors="replace")
+	def __init__(self, rules):
+		self.rules = rules
+		self.rules_by_tag = {}
 
-	# Handle character conversion regardless of whitelist status
-	if convert_characters:
-		for key, replacement in conversion_table.items():
-			if isinstance(replacement, bytes):
-				replacement = replacement.decode("utf-8")
-			html = html.replace(key, replacement)
+	def rules_for(self, name):
+		rules = self.rules_by_tag.get(name)
+		if rules is None:
+			rules = tuple(rule for rule in self.rules if rule.tags is None or name in rule.tags)
+			self.rules_by_tag[name] = rules
+		return rules
 
-	# The html5lib parser is required in order to preserve case-sensitivity of
-	# tags. Using html.parser will corrupt SVGs and possibly other XML tags.
-	soup = BeautifulSoup(html, "html5lib")
+	def run(self, soup):
+		context = TranscodeContext()
+		stack = [iter(list(soup.contents))]
+		while stack:
+			node = next(stack[-1], None)
+			if node is None:
+				stack.pop()
+				continue
+			if not isinstance(node, Tag):
+				continue
+			children = None
+			for rule in self.rules_for(node.name):
+				if rule.attrs is not None and rule.attrs.isdisjoint(node.attrs):
+					continue
+				children = rule.apply(node, context)
+				if children is not None:
+					break
+			stack.append(iter(children if children is not None else list(node.contents)))
+		return context
 
+def render_pre(tag, context):
 	# Contents of <pre> tags should always use HTML entities
-	for tag in soup.find_all(['pre']):
-		tag.replace_with(str(tag))
+	tag.replace_with(str(tag))
+	return []
 
+def rewrite_https_urls(tag, context):
 	# Always convert HTTPS to HTTP regardless of whitelist status
-	for tag in soup(['link', 'script', 'img', 'a', 'iframe']):
-		# Handle src attributes
-		if 'src' in tag.attrs:
-			if tag['src'].startswith('https://'):
-				tag['src'] = tag['src'].replace('https://', 'http://')
-			elif tag['src'].startswith('//'):  # Handle protocol-relative URLs
-				tag['src'] = 'http:' + tag['src']
-
-		# Handle href attributes
-		if 'href' in tag.attrs:
-			if tag['href'].startswith('https://'):
-				tag['href'] = tag['href'].replace('https://', 'http://')
-			elif tag['href'].startswith('//'):  # Handle protocol-relative URLs
-				tag['href'] = 'http:' + tag['href']
+	for attr in ('src', 'href'):
+		if attr in tag.attrs:
+			tag[attr] = rewrite_url(tag[attr])
 
-	# Check if domain is whitelisted
-	is_whitelisted = False
-	if url:
-		from urllib.parse import urlparse
-		domain = urlparse(url).netloc
-		is_whitelisted = any(domain.endswith(whitelisted) for whitelisted in whitelisted_domains)
+def unwrap_tag(tag, context):
+	children = list(tag.contents)
+	tag.unwrap()
+	return children
 
-	# Only perform tag/attribute stripping if the domain is not whitelisted and SIMPLIFY_HTML is True
-	if simplify_html and not is_whitelisted:
-		for tag in soup(tags_to_unwrap):
-			tag.unwrap()
-		for tag in soup(tags_to_strip):
-			tag.decompose()
-		for tag in soup():
-			for attr in attributes_to_strip:
-				if attr in tag.attrs:
-					del tag[attr]
+def strip_tag(tag, context):
+	if tag.name == 'script' and tag.get('src'):
+		context.stripped_assets.add(tag['src'])
+	elif is_stylesheet_link(tag.name, tag.get('rel')) and tag.get('href'):
+		context.stripped_assets.add(tag['href'])
+	tag.decompose()
+	return []
+
+def strip_attributes(attributes_to_strip):
+	def apply(tag, context):
+		for attr in attributes_to_strip:
+			if attr in tag.attrs:
+				del tag[attr]
+	return apply
 
+def rewrite_meta_refresh(tag, context):
 	# Always handle meta refresh tags
-	for tag in soup.find_all('meta', attrs={'http-equiv': 'refresh'}):
-		if 'content' in tag.attrs and 'https://' in tag['content']:
-			tag['content'] = tag['content'].replace('https://', 'http://')
+	if tag.get('http-equiv') == 'refresh' and 'content' in tag.attrs and 'https://' in tag['content']:
+		tag['content'] = tag['content'].replace('https://', 'http://')
 
+def rewrite_inline_css(tag, context):
 	# Always handle CSS with inline URLs
-	for tag in soup.find_all(['style', 'link']):
-		if tag.string:
-			tag.string = tag.string.replace('https://', 'http://')
-
-	# Handle inline SVGs - first pass
-	# if any SVG has a child element containing <use href="#value"> or
-	# <use xlink:href="#value"> then we need to find _another_ SVG on the page
-	# with a child element containing <symbol id="value">, and replace the
-	# contents of the first element with the contents of the second. If the
-	# symbol tag defines a viewport, that viewport needs to be copied to the
-	# parent of the use tag (which should be a svg tag)
-	for use_tag in soup.find_all(['use']):
+	if tag.string:
+		tag.string = tag.string.replace('https://', 'http://')
+
+def collect_svg(tag, context):
+	if tag.name == 'use':
+		context.use_tags.append(tag)
+	elif tag.name == 'svg':
+		context.svg_tags.append(tag)
+	elif 'id' in tag.attrs:
+		context.symbols.setdefault(tag['id'], tag)
+
+def build_pipeline(simplify, tags_to_unwrap, tags_to_strip, attributes_to_strip):
+	rules = [
+		TranscodeRule(render_pre, tags=['pre']),
+		TranscodeRule(rewrite_https_urls, tags=['link', 'script', 'img', 'a', 'iframe'], attrs=['src', 'href']),
+	]
+	if simplify:
+		rules += [
+			TranscodeRule(unwrap_tag, tags=tags_to_unwrap),
+			TranscodeRule(strip_tag, tags=tags_to_strip),
+			TranscodeRule(strip_attributes(attributes_to_strip), attrs=attributes_to_strip),
+		]
+	rules += [
+		TranscodeRule(rewrite_meta_refresh, tags=['meta'], attrs=['http-equiv']),
+		TranscodeRule(rewrite_inline_css, tags=['style', 'link']),
+		TranscodeRule(collect_svg, tags=['use', 'svg', 'symbol']),
+	]
+	return TranscodePipeline(rules)
+
+def get_pipeline(simplify, tags_to_unwrap, tags_to_strip, attributes_to_strip):
+	# Pipelines are built once per combination of settings
+	key = (simplify, tuple(tags_to_unwrap or ()), tuple(tags_to_strip or ()), tuple(attributes_to_strip or ()))
+	pipeline = pipelines.get(key)
+	if pipeline is None:
+		pipeline = build_pipeline(simplify, tags_to_unwrap or [], tags_to_strip or [], attributes_to_strip or [])
+		pipelines[key] = pipeline
+	return pipeline
+
+def get_svg_image_settings():
+	return conversion_settings(
+		resize=config.RESIZE_IMAGES,
+		max_width=config.MAX_IMAGE_WIDTH,
+		max_height=config.MAX_IMAGE_HEIGHT,
+		convert=config.CONVERT_IMAGES,
+		convert_to=config.CONVERT_IMAGES_TO_FILETYPE,
+		dithering=config.DITHERING_ALGORITHM,
+	)
+
+def queue_svg_image(fake_url, svg_source):
+	queue_image(fake_url, svg_source, **get_svg_image_settings())
+
+def resolve_svg_uses(context):
+	"""
+	Handle inline SVGs - first pass
+	if any SVG has a child element containing <use href="#value"> or
+	<use xlink:href="#value"> then we need to find _another_ SVG on the page
+	with a child element containing <symbol id="value">, and replace the
+	contents of the first element with the contents of the second. If the
+	symbol tag defines a viewport, that viewport needs to be copied to the
+	parent of the use tag (which should be a svg tag)
+	"""
+	for use_tag in context.use_tags:
 		attrs = use_tag.attrs
 		if 'href' in attrs:
 			attr = 'href'
 		elif 'xlink:href' in attrs:
 			attr = 'xlink:href'
-		symbol_tag = soup.find("symbol", {"id": use_tag[attr][1:]})
+		else:
+			continue
+		symbol_tag = context.symbols.get(use_tag[attr][1:])
+		if symbol_tag is None:
+			continue
 		if 'viewBox' in symbol_tag.attrs and use_tag.parent.name == 'svg' and 'viewBox' not in use_tag.parent.attrs:
 			use_tag.parent["viewBox"] = symbol_tag["viewBox"]
 		symbol_tag_copy = copy.copy(symbol_tag)
 		use_tag.replace_with(symbol_tag_copy)
 		symbol_tag_copy.unwrap()
 
-	# Handle inline SVGs - second pass
-	# Fetch, cache, and convert them - then replace the inline <svg> tag with
-	# an <img> tag whose src attribute points to this proxy _itself_.
-	for tag in soup.find_all(['svg']):
-
-		# Set height and width equal to the viewport if one is not specified
-		svg_attrs = tag.attrs
-		if "height" not in svg_attrs and "viewBox" in svg_attrs:
-			view_box = svg_attrs["viewBox"].split(" ")
-			tag["height"] = view_box[3]
-		if "width" not in svg_attrs and "viewBox" in svg_attrs:
-			view_box = svg_attrs["viewBox"].split(" ")
-			tag["width"] = view_box[2]
-
-		# Convert it to a gif (or other specified format)
-		fake_url = hashlib.md5(str(tag).encode()).hexdigest()
-		convert = config.CONVERT_IMAGES
-		convert_to = config.CONVERT_IMAGES_TO_FILETYPE
-		fetch_and_cache_image(
-			fake_url,
-			str(tag).encode('utf-8'),
-			resize=config.RESIZE_IMAGES,
-			max_width=config.MAX_IMAGE_WIDTH,
-			max_height=config.MAX_IMAGE_HEIGHT,
-			convert=convert,
-			convert_to=convert_to,
-			dithering=config.DITHERING_ALGORITHM,
-			hash_url=False,
-		)
-		extension = convert_to.lower() if convert and convert_to else "gif"
-
-		# The _external=True attribute of `url_for` doesn't work here, and will
-		# always return `localhost` instead of our host IP / port. So grab that
-		# info from the app config directly and prepend it to a relative URL instead.
-		relative_url = url_for('serve_cached_image', filename=f"{fake_url}.{extension}")
-		url = f"http://{current_app.config['MACPROXY_HOST_AND_PORT']}{relative_url}"
-		img_attrs = {"src": url}
-		if "height" in svg_attrs:
-			img_attrs["height"] = svg_attrs["height"]
-		if "width" in svg_attrs:
-			img_attrs["width"] = svg_attrs["width"]
-		img = soup.new_tag("img", **img_attrs)
-		tag.replace_with(img)
-
-	# Use the custom formatter when converting the soup back to a string
-	html = soup.decode(formatter=URLAwareHTMLFormatter())
-
-	html = html.replace('<br/>', '<br>')
-	html = html.replace('<hr/>', '<hr>')
-	
-	# Ensure the output is properly encoded
-	html_bytes = html.encode('utf-8')
-
-	return html_bytes
+def get_image_base_url():
+	"""
+	The URL that converted inline SVGs are served under, e.g.
+	"http://10.0.0.5:5001/cached_image/"
+	"""
+	# The _external=True attribute of `url_for` doesn't work here, and will
+	# always return `localhost` instead of our host IP / port. So grab that
+	# info from the app config directly and prepend it to a relative URL instead.
+	relative_url = url_for('serve_cached_image', filename='-')[:-1]
+	return f"http://{current_app.config['MACPROXY_HOST_AND_PORT']}{relative_url}"
+
+def replace_svg_with_img(soup, tag, context):
+	"""
+	Handle inline SVGs - second pass
+	Queue them for conversion - then replace the inline <svg> tag with an
+	<img> tag whose src attribute points to this proxy _itself_. The image
+	is converted by the time the browser asks for it.
+	"""
+
+	# Set height and width equal to the viewport if one is not specified
+	svg_attrs = tag.attrs
+	if "height" not in svg_attrs and "viewBox" in svg_attrs:
+		view_box = svg_attrs["viewBox"].split(" ")
+		tag["height"] = view_box[3]
+	if "width" not in svg_attrs and "viewBox" in svg_attrs:
+		view_box = svg_attrs["viewBox"].split(" ")
+		tag["width"] = view_box[2]
+
+	# Convert it to a gif (or other specified format) in the background.
+	# Identical SVGs (e.g. the same icon used many times) share one image.
+	svg_source = str(tag).encode('utf-8')
+	fake_url = hashlib.md5(svg_source).hexdigest()
+	if fake_url not in context.svg_images:
+		context.svg_images[fake_url] = svg_source
+		if context.queue_images:
+			queue_svg_image(fake_url, svg_source)
+
+	if context.image_base_url is None:
+		context.image_base_url = get_image_base_url()
+	img_attrs = {"src": context.image_base_url + cached_image_name(fake_url, get_svg_image_settings())}
+	if "height" in svg_attrs:
+		img_attrs["height"] = svg_attrs["height"]
+	if "width" in svg_attrs:
+		img_attrs["width"] = svg_attrs["width"]
+	img = soup.new_tag("img", **img_attrs)
+	tag.replace_with(img)
+	return img
+
+def rewrite_url(url):
+	# Always convert HTTPS to HTTP regardless of whitelist status
+	if url.startswith('https://'):
+		return url.replace('https://', 'http://')
+	elif url.startswith('//'):  # Handle protocol-relative URLs
+		return 'http:' + url
+	return url
+
+def rewrite_source_tag(match, encoding=OUTPUT_ENCODING):
+	source = match.group(0)
+	tag_name = match.group(1).lower()
+	is_meta = tag_name == 'meta'
+	# Every URL that needs rewriting contains "//"; most tags have none
+	if '//' not in source and not (is_meta and 'charset' in source.lower()):
+		return source
+	attrs = {m.group(2).lower(): m.group(3).strip('"\'') for m in SOURCE_ATTR_PATTERN.finditer(source)}
+
+	if is_meta:
+		rewritten = declare_charset(attrs, encoding)
+		# Always handle meta refresh tags
+		if attrs.get('http-equiv') == 'refresh' and 'https://' in attrs.get('content', ''):
+			rewritten['content'] = attrs['content'].replace('https://', 'http://')
+	else:
+		rewritten = {name: rewrite_url(attrs[name]) for name in ('src', 'href') if name in attrs}
+	rewritten = {name: value for name, value in rewritten.items() if value != attrs.get(name)}
+	if not rewritten:
+		return source
+
+	def rewrite_attr(attr_match):
+		name = attr_match.group(2).lower()
+		if name not in rewritten:
+			return attr_match.group(0)
+		value = attr_match.group(3)
+		quote = value[0] if value[0] in '"\'' else ''
+		return attr_match.group(1) + quote + rewritten[name] + quote
+
+	return SOURCE_ATTR_PATTERN.sub(rewrite_attr, source)
+
+def rewrite_style_element(match):
+	# Always handle CSS with inline URLs
+	return match.group(1) + match.group(2).replace('https://', 'http://') + match.group(3)
+
+def rewrite_source_urls(html, encoding=OUTPUT_ENCODING):
+	"""
+	The parse-free equivalent of the transcoder for pages that aren't
+	simplified: rewrites the URLs (and any <meta> charset) in the page's
+	source, and leaves everything else as the site sent it.
+	"""
+	html = SOURCE_TAG_PATTERN.sub(lambda match: rewrite_source_tag(match, encoding), html)
+	return SOURCE_STYLE_PATTERN.sub(rewrite_style_element, html)
+
+# The text of these elements isn't escaped in trees from extensions (<pre> and
+# <svg> are serialized with str(), which escapes it)
+RAW_TEXT_ELEMENTS = {'script', 'style', 'pre', 'svg'}
+
+def prepare_tree(soup, transliterator=None):
+	"""
+	Gets a tree an extension built ready for the pipeline. Its text is
+	escaped the way str(soup) would have, since the serializer writes text
+	out as it is, and character conversion is applied to text and attribute
+	values. Inline SVGs are reparsed with html5lib if the tree was built by
+	another parser, which would have lowercased names such as viewBox.
+	"""
+	reparse_svg = 'html5lib' not in soup.builder.features
+	stack = [(soup, False)]
+	while stack:
+		tag, raw = stack.pop()
+		for node in list(tag.contents):
+			if isinstance(node, Tag):
+				if reparse_svg and node.name == 'svg':
+					parsed = BeautifulSoup(str(node), 'html5lib').svg
+					node.replace_with(parsed)
+					node = parsed
+				if transliterator:
+					for key, value in node.attrs.items():
+						if isinstance(value, str):
+							node[key] = transliterator.convert(value)
+						elif isinstance(value, list):
+							node[key] = [transliterator.convert(item) for item in value]
+				stack.append((node, raw or node.name in RAW_TEXT_ELEMENTS))
+				continue
+			text = transliterator.convert(node) if transliterator else node
+			# Comments, doctypes etc. are written out with their own delimiters
+			if type(node) is NavigableString and not raw:
+				text = html.escape(text, quote=False)
+			if text != node:
+				node.replace_with(type(node)(text))
+
+def transcode_html_uncached(html, url=None, whitelisted_domains=None, simplify_html=False,
+				  tags_to_unwrap=None, tags_to_strip=None, attributes_to_strip=None,
+				  convert_characters=False, conversion_table=None, charset=None):
+	"""
+	Uses BeautifulSoup to transcode payloads of the text/html content type
+	"""
+	return transcode_page(html, url, whitelisted_domains, simplify_html, tags_to_unwrap,
+		tags_to_strip, attributes_to_strip, convert_characters, conversion_table, charset)[0]
+
+def transcode_page(html, url=None, whitelisted_domains=None, simplify_html=False,
+				  tags_to_unwrap=None, tags_to_strip=None, attributes_to_strip=None,
+				  convert_characters=False, conversion_table=None, charset=None):
+	"""
+	Runs transcode_document() in the transcode pool if there is one and the
+	page is big enough to be worth sending there, else on this thread.
+	Trees from extensions are always transcoded here.
+	"""
+	result = None
+	if isinstance(html, (str, bytes)) and use_transcode_pool(len(html)):
+		if isinstance(html, str):
+			html, charset = html.encode('utf-8', errors='surrogatepass'), 'utf-8'
+		result = run_in_pool("transcode", transcode_document, html, url, whitelisted_domains, simplify_html,
+			tags_to_unwrap, tags_to_strip, attributes_to_strip, convert_characters, conversion_table,
+			charset, image_base_url=get_image_base_url(), queue_images=False)
+		if result is not None:
+			svg_images = result[1]
+			for fake_url, svg_source in svg_images.items():
+				queue_svg_image(fake_url, svg_source)
+	if result is None:
+		result = transcode_document(html, url, whitelisted_domains, simplify_html, tags_to_unwrap,
+			tags_to_strip, attributes_to_strip, convert_characters, conversion_table, charset)
+	remember_stripped_assets(url, result[2])
+	return result
+
+def transcode_document(html, url=None, whitelisted_domains=None, simplify_html=False,
+				  tags_to_unwrap=None, tags_to_strip=None, attributes_to_strip=None,
+				  convert_characters=False, conversion_table=None, charset=None,
+				  image_base_url=None, queue_images=True):
+	"""
+	Returns the transcoded page, encoded in OUTPUT_ENCODING, the source of
+	each inline SVG it refers to, by name, and the URLs of the scripts and
+	stylesheets it no longer refers to. The page can be given as bytes, a
+	str, or a BeautifulSoup tree (which is modified in place).
+
+	Outside of a request (in a transcode worker process), image_base_url
+	has to be given, and queue_images should be False: the caller queues
+	the returned SVGs itself.
+	"""
+
+	# Check if domain is whitelisted
+	is_whitelisted = False
+	if url:
+		domain = urlparse(url).netloc
+		is_whitelisted = any(domain.endswith(whitelisted) for whitelisted in whitelisted_domains)
+
+	# Only perform tag/attribute stripping if the domain is not whitelisted and SIMPLIFY_HTML is True
+	simplify = simplify_html and not is_whitelisted
+
+	if isinstance(html, BeautifulSoup):
+		# An extension's page, already parsed: transform its tree as it is
+		soup = html
+		# Handle character conversion regardless of whitelist status
+		prepare_tree(soup, get_transliterator(conversion_table) if convert_characters else None)
+	else:
+		# The only decode of the page: everything after this works on the one str
+		if isinstance(html, bytes):
+			html = decode_html(html, charset)
+
+		# Handle character conversion regardless of whitelist status
+		if convert_characters:
+			html = get_transliterator(conversion_table).convert(html)
+
+		if not simplify and HTML_FAST_PATH and not SVG_TAG_PATTERN.search(html):
+			return rewrite_source_urls(html).encode(OUTPUT_ENCODING, errors='xmlcharrefreplace'), {}, set()
+
+		# The html5lib parser is required in order to preserve case-sensitivity of
+		# tags. Using html.parser will corrupt SVGs and possibly other XML tags.
+		# Pages without any such tags can use the much faster lxml parser.
+		soup = BeautifulSoup(html, choose_parser(html))
+
+	pipeline = get_pipeline(simplify, tags_to_unwrap, tags_to_strip, attributes_to_strip)
+	context = pipeline.run(soup)
+	context.image_base_url = image_base_url
+	context.queue_images = queue_images
+
+	resolve_svg_uses(context)
+	for tag in context.svg_tags:
+		replace_svg_with_img(soup, tag, context)
+
+	return serialize_html(soup), context.svg_images, context.stripped_assets
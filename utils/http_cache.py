@@ -0,0 +1,362 @@
+# Standard library imports
+import calendar
+import email.utils
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+# Third-party imports
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# First-party imports
+from utils.cache_utils import LRUCache
+from utils.system_utils import load_preset
+
+# Get config
+config = load_preset()
+
+HTTP_CACHE_ENABLED = getattr(config, 'HTTP_CACHE_ENABLED', True)
+MEMORY_BYTES = getattr(config, 'HTTP_CACHE_MEMORY_BYTES', 32 * 1024 * 1024)
+DISK_BYTES = getattr(config, 'HTTP_CACHE_DISK_BYTES', 256 * 1024 * 1024)
+MAX_ENTRY_BYTES = getattr(config, 'HTTP_CACHE_MAX_ENTRY_BYTES', 4 * 1024 * 1024)
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), "cached_responses")
+
+# Status codes that may be cached without explicit freshness information (RFC 9111, 4.2.2)
+HEURISTIC_STATUS_CODES = (200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501)
+
+# Heuristic freshness: 10% of the time since Last-Modified, capped at one day
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX_AGE = 24 * 60 * 60
+
+# Headers that are updated from a 304 Not Modified response
+REVALIDATION_HEADERS = ('Cache-Control', 'Date', 'ETag', 'Expires', 'Last-Modified', 'Age', 'Vary')
+
+
+class CacheEntry:
+	def __init__(self, url, status_code, reason, headers, content, vary, response_time):
+		self.url = url
+		self.status_code = status_code
+		self.reason = reason
+		self.headers = headers
+		self.content = content
+		self.vary = vary
+		self.response_time = response_time
+
+	def size(self):
+		return len(self.content) + sum(len(k) + len(v) for k, v in self.headers.items())
+
+def parse_cache_control(value):
+	directives = {}
+	for part in (value or '').split(','):
+		name, _, arg = part.strip().partition('=')
+		if name:
+			directives[name.lower()] = arg.strip('"') if arg else None
+	return directives
+
+def parse_http_date(value):
+	try:
+		parsed = email.utils.parsedate_tz(value)
+		return calendar.timegm(parsed[:9]) - (parsed[9] or 0) if parsed else None
+	except (TypeError, ValueError):
+		return None
+
+def parse_seconds(value):
+	try:
+		return max(0, int(value))
+	except (TypeError, ValueError):
+		return None
+
+def freshness_lifetime(entry):
+	"""
+	How long a response stays fresh, from s-maxage/max-age, Expires, or
+	a Last-Modified heuristic, in that order (RFC 9111, 4.2.1).
+	"""
+	headers = entry.headers
+	cache_control = parse_cache_control(headers.get('Cache-Control'))
+	if 'no-cache' in cache_control:
+		return 0
+	for directive in ('s-maxage', 'max-age'):
+		if directive in cache_control:
+			seconds = parse_seconds(cache_control[directive])
+			if seconds is not None:
+				return seconds
+	if 'Expires' in headers:
+		expires = parse_http_date(headers['Expires'])
+		date = parse_http_date(headers.get('Date')) or entry.response_time
+		return max(0, expires - date) if expires is not None else 0
+	last_modified = parse_http_date(headers.get('Last-Modified'))
+	if last_modified is not None and entry.status_code in HEURISTIC_STATUS_CODES:
+		date = parse_http_date(headers.get('Date')) or entry.response_time
+		return min(HEURISTIC_MAX_AGE, max(0, (date - last_modified) * HEURISTIC_FRACTION))
+	return 0
+
+def current_age(entry, now):
+	age = parse_seconds(entry.headers.get('Age')) or 0
+	return age + (now - entry.response_time)
+
+def is_fresh(entry, request_headers):
+	request_cache_control = parse_cache_control(request_headers.get('Cache-Control'))
+	if 'no-cache' in request_cache_control or request_headers.get('Pragma') == 'no-cache':
+		return False
+	lifetime = freshness_lifetime(entry)
+	if 'max-age' in request_cache_control:
+		lifetime = min(lifetime, parse_seconds(request_cache_control['max-age']) or 0)
+	return current_age(entry, time.time()) < lifetime
+
+def is_storable(response, request_headers):
+	"""
+	Whether a response may be kept in a cache shared by all clients (RFC 9111, 3).
+	"""
+	cache_control = parse_cache_control(response.headers.get('Cache-Control'))
+	if 'no-store' in cache_control or 'private' in cache_control:
+		return False
+	if 'no-store' in parse_cache_control(request_headers.get('Cache-Control')):
+		return False
+	if 'Authorization' in request_headers and 'public' not in cache_control and 's-maxage' not in cache_control:
+		return False
+	# A temporary redirect must not be remembered as the content of the original URL
+	if any(r.status_code not in (301, 308) for r in response.history):
+		return False
+	# Never hand one client's cookies to another
+	if 'Set-Cookie' in response.headers:
+		return False
+	if response.headers.get('Vary', '').strip() == '*':
+		return False
+	has_explicit_freshness = ('max-age' in cache_control or 's-maxage' in cache_control or
+							  'Expires' in response.headers or 'public' in cache_control)
+	has_validator = 'ETag' in response.headers or 'Last-Modified' in response.headers
+	return has_explicit_freshness or (response.status_code in HEURISTIC_STATUS_CODES and has_validator)
+
+def vary_values(vary_header, request_headers):
+	names = [name.strip().lower() for name in (vary_header or '').split(',') if name.strip()]
+	return {name: request_headers.get(name) for name in names}
+
+class HTTPCache:
+	"""
+	Two-tier cache of upstream responses: an in-memory LRU in front of a
+	sharded directory on disk. The disk tier is shared by every worker.
+	"""
+
+	def __init__(self, cache_dir=CACHE_DIR, memory_bytes=MEMORY_BYTES, disk_bytes=DISK_BYTES):
+		self.cache_dir = cache_dir
+		self.disk_bytes = disk_bytes
+		self.memory = LRUCache(max_bytes=memory_bytes, sizeof=CacheEntry.size)
+		self.disk_usage = None
+		self.lock = threading.Lock()
+		self.counts = {"hits": 0, "misses": 0, "revalidated": 0, "stored": 0, "uncacheable": 0}
+
+	def count(self, name):
+		with self.lock:
+			self.counts[name] += 1
+
+	def path_for(self, key):
+		return os.path.join(self.cache_dir, key[:2], key + ".cache")
+
+	def load(self, key):
+		entry = self.memory.get(key)
+		if entry is not None:
+			return entry
+		path = self.path_for(key)
+		try:
+			with open(path, 'rb') as f:
+				entry = pickle.load(f)
+			os.utime(path)
+		except (OSError, EOFError, pickle.UnpicklingError):
+			return None
+		self.memory.set(key, entry)
+		return entry
+
+	def store(self, key, entry):
+		self.memory.set(key, entry)
+		path = self.path_for(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		# Write to a temp file and rename it, so other workers never see half an entry
+		previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+		fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(temp_path, path)
+		except OSError:
+			if os.path.exists(temp_path):
+				os.unlink(temp_path)
+			return
+		self.count("stored")
+		self.track_disk_usage(os.path.getsize(path) - previous_size)
+
+	def track_disk_usage(self, added):
+		with self.lock:
+			if self.disk_usage is None:
+				# First write since startup; the scan already includes it
+				self.disk_usage = sum(size for _, size, _ in self.disk_files())
+			else:
+				self.disk_usage += added
+			if self.disk_usage <= self.disk_bytes:
+				return
+			# Evict least recently used files until we're 10% under the cap
+			target = self.disk_bytes * 0.9
+			for path, size, _ in sorted(self.disk_files(), key=lambda item: item[2]):
+				if self.disk_usage <= target:
+					break
+				try:
+					os.unlink(path)
+					self.disk_usage -= size
+				except OSError:
+					pass
+
+	def disk_files(self):
+		for root, _, files in os.walk(self.cache_dir):
+			for name in files:
+				path = os.path.join(root, name)
+				try:
+					stat = os.stat(path)
+				except OSError:
+					continue
+				yield path, stat.st_size, stat.st_mtime
+
+	def stats(self):
+		with self.lock:
+			stats = dict(self.counts)
+		stats["memory"] = self.memory.stats()
+		return stats
+
+cache = HTTPCache()
+
+def cache_key(url):
+	return hashlib.sha256(url.encode()).hexdigest()
+
+def response_from_entry(entry):
+	response = requests.Response()
+	response.status_code = entry.status_code
+	response.reason = entry.reason
+	response.headers = CaseInsensitiveDict(entry.headers)
+	response.url = entry.url
+	response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+	response._content = entry.content
+	response._content_consumed = True
+	response.from_cache = True
+	return response
+
+def entry_from_response(response, content, request_headers, response_time):
+	# requests has already undone any Content-Encoding
+	headers = {k: v for k, v in response.headers.items() if k.lower() not in ('content-encoding', 'transfer-encoding', 'connection')}
+	headers['Content-Length'] = str(len(content))
+	return CacheEntry(
+		url=response.url,
+		status_code=response.status_code,
+		reason=response.reason,
+		headers=headers,
+		content=content,
+		vary=vary_values(response.headers.get('Vary'), request_headers),
+		response_time=response_time,
+	)
+
+def store_when_read(response, key, request_headers, response_time):
+	"""
+	Copies a streamed response's body into the cache as the caller reads it,
+	so streaming isn't held up. The entry is only stored once the body has
+	been read to the end; if the reader stops early, the download fails, or
+	the body grows past MAX_ENTRY_BYTES, nothing is stored.
+	"""
+	iter_content = response.iter_content
+
+	def iter_and_store(chunk_size=1, decode_unicode=False):
+		chunks = [] if not decode_unicode else None
+		size = 0
+		for chunk in iter_content(chunk_size, decode_unicode):
+			if chunks is not None:
+				size += len(chunk)
+				if size <= MAX_ENTRY_BYTES:
+					chunks.append(chunk)
+				else:
+					chunks = None
+					cache.count("uncacheable")
+			yield chunk
+		if chunks is not None:
+			response.iter_content = iter_content
+			cache.store(key, entry_from_response(response, b''.join(chunks), request_headers, response_time))
+
+	# Response.content reads through iter_content too, so this covers both
+	response.iter_content = iter_and_store
+
+class CachingSession(requests.Session):
+	"""
+	requests.Session that answers GET requests from the shared HTTP cache
+	when it can, and revalidates stale entries with conditional requests.
+	"""
+
+	def request(self, method, url, params=None, headers=None, **kwargs):
+		if not HTTP_CACHE_ENABLED or method.upper() != 'GET':
+			return super().request(method, url, params=params, headers=headers, **kwargs)
+
+		prepared = requests.Request('GET', url, params=params).prepare()
+		request_headers = CaseInsensitiveDict(self.headers)
+		request_headers.update({k: v for k, v in (headers or {}).items() if v is not None})
+		key = cache_key(prepared.url)
+
+		entry = cache.load(key)
+		if entry is not None and entry.vary != vary_values(entry.headers.get('Vary'), request_headers):
+			entry = None
+
+		if entry is not None and is_fresh(entry, request_headers):
+			cache.count("hits")
+			print(f"HTTP cache hit: {prepared.url}")
+			return response_from_entry(entry)
+
+		# Stale (or missing): ask the origin, conditionally if we have validators
+		conditional_headers = dict(headers or {})
+		if entry is not None:
+			if 'ETag' in entry.headers:
+				conditional_headers['If-None-Match'] = entry.headers['ETag']
+			if 'Last-Modified' in entry.headers:
+				conditional_headers['If-Modified-Since'] = entry.headers['Last-Modified']
+
+		response = super().request(method, url, params=params, headers=conditional_headers, **kwargs)
+		response_time = time.time()
+
+		if entry is not None and response.status_code == 304:
+			cache.count("revalidated")
+			print(f"HTTP cache revalidated: {prepared.url}")
+			for name in REVALIDATION_HEADERS:
+				if name in response.headers:
+					entry.headers[name] = response.headers[name]
+			entry.response_time = response_time
+			cache.store(key, entry)
+			response.close()
+			return response_from_entry(entry)
+
+		cache.count("misses")
+		length = parse_seconds(response.headers.get('Content-Length'))
+		if not is_storable(response, request_headers) or (length is not None and length > MAX_ENTRY_BYTES):
+			cache.count("uncacheable")
+		elif kwargs.get('stream'):
+			store_when_read(response, key, request_headers, response_time)
+		elif len(response.content) <= MAX_ENTRY_BYTES:
+			cache.store(key, entry_from_response(response, response.content, request_headers, response_time))
+		else:
+			cache.count("uncacheable")
+		response.from_cache = False
+		return response
+
+session = CachingSession()
+
+def reset_session():
+	# Pooled connections must not be shared with a forked worker process
+	global session
+	session = CachingSession()
+
+os.register_at_fork(after_in_child=reset_session)
+
+def get(url, params=None, **kwargs):
+	"""
+	Drop-in replacement for requests.get() that goes through the HTTP cache.
+	"""
+	return session.get(url, params=params, **kwargs)
+
+def get_stats():
+	return cache.stats()
@@ -0,0 +1,155 @@
+# Standard library imports
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# First-party imports
+from utils.system_utils import load_preset
+
+# Get config
+config = load_preset()
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), "cached_images")
+MAX_BYTES = getattr(config, 'IMAGE_CACHE_BYTES', 256 * 1024 * 1024)
+
+# Name of the index, kept in the cache directory next to the images
+INDEX_NAME = "index.sqlite"
+
+# Files that are written next to images, but aren't cached images themselves
+SPOOL_SUFFIXES = (".pending", ".tmp")
+
+
+def write_atomically(path, data):
+	# Write to a temp file and rename it, so other workers never see half a file
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(data)
+		os.replace(temp_path, path)
+	except OSError:
+		if os.path.exists(temp_path):
+			os.unlink(temp_path)
+		raise
+
+class ImageCache:
+	"""
+	Converted images on disk, spread over subdirectories named after the first
+	two characters of a hash of the file name. A SQLite index of each image's
+	size and last use is shared by every worker process, so the cache's size is
+	known at startup without walking the directory. Once it grows past
+	`max_bytes`, the least recently used images are removed.
+	"""
+
+	def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		self.index_path = os.path.join(cache_dir, INDEX_NAME)
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.counts = {"stored": 0, "evicted": 0}
+
+		os.makedirs(cache_dir, exist_ok=True)
+		is_new = not os.path.exists(self.index_path)
+		conn = self.connect()
+		conn.execute("CREATE TABLE IF NOT EXISTS images (name TEXT PRIMARY KEY, size INTEGER, used REAL)")
+		conn.execute("CREATE INDEX IF NOT EXISTS images_by_use ON images (used)")
+		if is_new:
+			self.rebuild_index()
+
+	def connect(self):
+		# sqlite connections can't be shared between threads, and must not be
+		# reused in a child process after a fork.
+		if getattr(self.local, 'pid', None) != os.getpid():
+			conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+			conn.execute("PRAGMA journal_mode=WAL")
+			conn.execute("PRAGMA synchronous=NORMAL")
+			self.local.conn = conn
+			self.local.pid = os.getpid()
+		return self.local.conn
+
+	def count(self, name, amount=1):
+		with self.lock:
+			self.counts[name] += amount
+
+	def directory_for(self, name):
+		return os.path.join(self.cache_dir, hashlib.md5(name.encode()).hexdigest()[:2])
+
+	def path_for(self, name):
+		return os.path.join(self.directory_for(name), name)
+
+	def contains(self, name):
+		return os.path.exists(self.path_for(name))
+
+	def touch(self, name):
+		self.connect().execute("UPDATE images SET used = ? WHERE name = ?", (time.time(), name))
+
+	def store(self, name, data):
+		write_atomically(self.path_for(name), data)
+		self.connect().execute(
+			"INSERT INTO images (name, size, used) VALUES (?, ?, ?) "
+			"ON CONFLICT (name) DO UPDATE SET size = excluded.size, used = excluded.used",
+			(name, len(data), time.time())
+		)
+		self.count("stored")
+		self.evict()
+
+	def usage(self):
+		files, size = self.connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images").fetchone()
+		return files, size
+
+	def evict(self):
+		_, size = self.usage()
+		if size <= self.max_bytes:
+			return
+		# Remove least recently used images until we're 10% under the cap
+		conn = self.connect()
+		excess = size - self.max_bytes * 0.9
+		for name, image_size in conn.execute("SELECT name, size FROM images ORDER BY used").fetchall():
+			if excess <= 0:
+				break
+			try:
+				os.unlink(self.path_for(name))
+			except OSError:
+				pass
+			conn.execute("DELETE FROM images WHERE name = ?", (name,))
+			excess -= image_size
+			self.count("evicted")
+
+	def rebuild_index(self):
+		"""
+		Indexes images left by a run without an index. Images from before the
+		cache was split into subdirectories can't be found anymore, and are removed.
+		"""
+		conn = self.connect()
+		for root, _, files in os.walk(self.cache_dir):
+			for name in files:
+				path = os.path.join(root, name)
+				if name.startswith(INDEX_NAME):
+					continue
+				if root == self.cache_dir or name.endswith(SPOOL_SUFFIXES) or path != self.path_for(name):
+					try:
+						os.unlink(path)
+					except OSError:
+						pass
+					continue
+				try:
+					stat = os.stat(path)
+				except OSError:
+					continue
+				conn.execute(
+					"INSERT OR REPLACE INTO images (name, size, used) VALUES (?, ?, ?)",
+					(name, stat.st_size, stat.st_mtime)
+				)
+		self.evict()
+
+	def stats(self):
+		with self.lock:
+			stats = dict(self.counts)
+		stats["files"], stats["bytes"] = self.usage()
+		return stats
+
+cache = ImageCache()
@@ -3,36 +3,192 @@ import hashlib
 import io
 import mimetypes
 import os
+import pickle
+import re
+import shutil
+import stat
 import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # Third-party imports
 import requests
-from PIL import Image, UnidentifiedImageError
+from PIL import Image, ImageFile, UnidentifiedImageError
 from PILSVG import SVG
 
+try:
+	import skia
+except ImportError:
+	skia = None
+
+# First-party imports
+from utils.dither_utils import COLOR_MODES, get_palette, reduce_colors, resolve_color_mode, resolve_dithering
+from utils.image_cache import cache as image_cache, write_atomically
+from utils.pool_utils import run_in_pool
+from utils.system_utils import load_preset
+
+# Get config
+config = load_preset()
+
+# Inline SVGs are rasterized by this many background threads, while the page
+# that contains them is already on its way to the browser
+SVG_RASTERIZE_THREADS = getattr(config, 'SVG_RASTERIZE_THREADS', 2)
+
+# Images waiting for a background thread are spooled next to their final path
+# with this suffix, so any worker process can finish them on demand
+PENDING_SUFFIX = ".pending"
+
+# At most this many image conversions are queued or running at once (in the
+# image worker processes, see IMAGE_PROCESSES); any more wait for a free slot
+IMAGE_QUEUE_SIZE = getattr(config, 'IMAGE_QUEUE_SIZE', 32)
+
+# How images are shrunk to MAX_IMAGE_WIDTH x MAX_IMAGE_HEIGHT: "fast", "balanced" or "best"
+RESIZE_QUALITY = getattr(config, 'IMAGE_RESIZE_QUALITY', 'balanced')
+
+# For each RESIZE_QUALITY, the resampling filter, and the reducing gap: large
+# images are first shrunk by cheap integer steps (JPEG decoding at 1/2, 1/4 or
+# 1/8 scale, then Image.reduce()) to no less than this many times the final
+# size. None resamples the full-size image, which is slowest.
+RESIZE_QUALITIES = {
+	"fast": (Image.Resampling.BILINEAR, 1.0),
+	"balanced": (Image.Resampling.LANCZOS, 2.0),
+	"best": (Image.Resampling.LANCZOS, None),
+}
+
+# Colors that converted GIFs are reduced to, see dither_utils.COLOR_MODES
+COLOR_MODE = resolve_color_mode(getattr(config, 'IMAGE_COLOR_MODE', 'BLACK_AND_WHITE'))
+
+# How SVGs are rasterized: "skia" (in this process, without temp files), "inkscape"
+# (supports more of SVG, but is started for every image), or "auto": skia, or inkscape
+# if skia can't be imported and inkscape is installed
+SVG_RENDERER = getattr(config, 'SVG_RENDERER', 'auto')
+
+# Size of an SVG that doesn't give one, as in browsers
+DEFAULT_SVG_SIZE = (300, 150)
+
+# Images are refused if they're bigger than this, as declared in their Content-Length or
+# while they download, or if they'd decode to more pixels than this, even at a reduced scale
+IMAGE_MAX_BYTES = getattr(config, 'IMAGE_MAX_BYTES', 16 * 1024 * 1024)
+IMAGE_MAX_PIXELS = getattr(config, 'IMAGE_MAX_PIXELS', 40 * 1000 * 1000)
+
+# Seconds to wait for an image's server to accept the connection, or to send more of the image
+IMAGE_FETCH_TIMEOUT = getattr(config, 'IMAGE_FETCH_TIMEOUT', 30)
+IMAGE_FETCH_CHUNK_SIZE = 16 * 1024
+
+# The dimensions of an image are looked for in this much of its start
+IMAGE_SNIFF_BYTES = 64 * 1024
+
+# JPEGs can be decoded at down to 1/8 scale, so they may have this many times IMAGE_MAX_PIXELS
+JPEG_DRAFT_FACTOR = 8 * 8
+
+# Names of converted images, see cached_image_name()
+CACHED_IMAGE_NAME = re.compile(r"[0-9a-f]{32}-[0-9a-f]{8}\.[a-z0-9]+")
 
-CACHE_DIR = os.path.join(os.path.dirname(__file__), "cached_images")
 USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
 
+class ImageTooLarge(Exception):
+	pass
+
+def check_pixels(width, height, max_pixels=IMAGE_MAX_PIXELS):
+	if max_pixels and width * height > max_pixels:
+		raise ImageTooLarge(f"{width}x{height} pixels is more than {max_pixels}")
+
+def read_image(response, max_bytes=IMAGE_MAX_BYTES, max_pixels=IMAGE_MAX_PIXELS):
+	"""
+	Reads the body of a streamed image response, refusing the image as soon
+	as it's known to be too big: from its Content-Length, as it downloads,
+	or from the dimensions in its header, which are parsed from the first
+	chunks without waiting for the rest.
+	"""
+	length = response.headers.get('Content-Length', '')
+	if max_bytes and length.isdigit() and int(length) > max_bytes:
+		response.close()
+		raise ImageTooLarge(f"{length} bytes is more than {max_bytes}")
+
+	parser = ImageFile.Parser()
+	sniffing = True
+	chunks = []
+	size = 0
+	try:
+		for chunk in response.iter_content(IMAGE_FETCH_CHUNK_SIZE):
+			size += len(chunk)
+			if max_bytes and size > max_bytes:
+				raise ImageTooLarge(f"more than {max_bytes} bytes")
+			chunks.append(chunk)
+			if not sniffing:
+				continue
+			try:
+				parser.feed(chunk)
+			except Image.DecompressionBombError as e:
+				raise ImageTooLarge(str(e))
+			except Exception:
+				# Not something Pillow can read (such as an SVG), or a broken
+				# image; either way, optimize_image() finds out
+				sniffing = False
+			if parser.image is not None:
+				sniffing = False
+				width, height = parser.image.size
+				check_pixels(width, height, max_pixels * (JPEG_DRAFT_FACTOR if parser.image.format == 'JPEG' else 1))
+			elif size >= IMAGE_SNIFF_BYTES:
+				sniffing = False
+	finally:
+		response.close()
+	return b''.join(chunks)
+
 def get_svg_renderer():
-	# If inkscape is installed and in the path, use that, because it supports
-	# more SVG functionality. Otherwise, fall back to using skia.
-	renderer='skia'
-	if 'PATH' in os.environ:
-		paths = os.environ['PATH'].split(':')
-		for path in paths:
-			exp_path = os.path.expandvars(os.path.join(path, 'inkscape'))
-			if os.path.exists(exp_path):
-				renderer='inkscape'
-				break
-	return renderer
+	# Skia draws in-process, without starting a program for every image, so
+	# it's preferred whenever it can be imported. Inkscape, if it's in the
+	# path, is the fallback; it has to be asked for to be used over skia.
+	if SVG_RENDERER != 'auto':
+		return SVG_RENDERER
+	if skia is None and shutil.which('inkscape'):
+		return 'inkscape'
+	return 'skia'
+
+def rasterize_svg(svg_data, max_size=None):
+	"""
+	Renders an SVG, scaled down to fit max_size if it's bigger. skia renders
+	it straight from memory; inkscape is run by PILSVG, which needs a file.
+	"""
+	if svg_renderer == 'skia' and skia is not None:
+		dom = skia.SVGDOM.MakeFromStream(skia.MemoryStream(svg_data))
+		if dom is None:
+			raise UnidentifiedImageError("cannot identify image file")
+		size = dom.containerSize()
+		width, height = size.width(), size.height()
+		if not width or not height:
+			width, height = DEFAULT_SVG_SIZE
+			dom.setContainerSize(skia.Size(width, height))
+		# Vector images can be drawn at their final size, rather than resized afterwards
+		scale = min(1, max_size[0] / width, max_size[1] / height) if max_size else 1
+		check_pixels(int(width * scale), int(height * scale))
+		surface = skia.Surface(max(1, int(width * scale)), max(1, int(height * scale)))
+		with surface as canvas:
+			canvas.scale(scale, scale)
+			dom.render(canvas)
+		pixels = surface.makeImageSnapshot().toarray(colorType=skia.kRGBA_8888_ColorType)
+		return Image.fromarray(pixels, 'RGBA')
+
+	# PILSVG doesn't support loading an image directly from a
+	# byte stream, only from a file on disk. So create a temp file,
+	# save the image data there, and then pass the path to PILSVG.
+	with tempfile.NamedTemporaryFile(delete=False) as fp:
+		try:
+			fp.write(svg_data)
+			fp.close()
+			return SVG(fp.name).im(renderer=svg_renderer)
+		finally:
+			fp.close()
+			os.unlink(fp.name)
 
 def is_image_url(url):
 	mime_type, _ = mimetypes.guess_type(url)
 	return mime_type and mime_type.startswith('image/')
 
 def optimize_image(image_data, resize=True, max_width=512, max_height=342, 
-				  convert=True, convert_to='gif', dithering='FLOYDSTEINBERG'):
+				  convert=True, convert_to='gif', dithering='FLOYDSTEINBERG', resize_quality=RESIZE_QUALITY,
+				  color_mode=COLOR_MODE):
 	try:
 
 		# Try to open the image directly using PIL
@@ -40,17 +196,21 @@ def optimize_image(image_data, resize=True, max_width=512, max_height=342,
 		try:
 			img = Image.open(io.BytesIO(image_data))
 		except UnidentifiedImageError:
-			# PILSVG doesn't support loading an image directly from a
-			# byte stream, only from a file on disk. So create a temp file,
-			# save the image data there, and then pass the path to PILSVG.
-			with tempfile.NamedTemporaryFile(delete=False) as fp:
-				try:
-					fp.write(image_data)
-					fp.close()
-					img = SVG(fp.name).im(renderer=get_svg_renderer())
-				finally:
-					fp.close()
-					os.unlink(fp.name)
+			img = rasterize_svg(image_data, (max_width, max_height) if resize and max_width and max_height else None)
+
+		# Work out the final size from the header, before anything is decoded
+		new_size = None
+		if resize and max_width and max_height:
+			width, height = img.size
+			if width > max_width or height > max_height:
+				ratio = min(max_width / width, max_height / height)
+				new_size = (int(width * ratio), int(height * ratio))
+		resample, reducing_gap = RESIZE_QUALITIES.get(str(resize_quality).lower(), RESIZE_QUALITIES["balanced"])
+		if new_size and reducing_gap:
+			# Only JPEGs can be decoded at a smaller scale; for anything else this does nothing
+			img.draft('RGB', (int(new_size[0] * reducing_gap), int(new_size[1] * reducing_gap)))
+		# Nothing has been decoded yet; refuse images that would take too much memory
+		check_pixels(*img.size)
 
 		# Convert RGBA images to RGB with white background
 		if img.mode == 'RGBA':
@@ -61,20 +221,14 @@ def optimize_image(image_data, resize=True, max_width=512, max_height=342,
 			img = img.convert('RGB')
 		
 		# Resize if enabled and necessary
-		if resize and max_width and max_height:
-			width, height = img.size
-			if width > max_width or height > max_height:
-				ratio = min(max_width / width, max_height / height)
-				new_size = (int(width * ratio), int(height * ratio))
-				img = img.resize(new_size, Image.Resampling.LANCZOS)
+		if new_size:
+			img = img.resize(new_size, resample, reducing_gap=reducing_gap)
 		
 		# Convert format if enabled
 		if convert and convert_to:
 			if convert_to.lower() == 'gif':
-				# For black and white GIF
-				img = img.convert("L")  # Convert to grayscale first
-				dither_method = Image.Dither.FLOYDSTEINBERG if dithering and dithering.upper() == 'FLOYDSTEINBERG' else None
-				img = img.convert("1", dither=dither_method)
+				# Black and white by default, or grays or an indexed color palette
+				img = reduce_colors(img, color_mode, dithering)
 			else:
 				# For other format conversions
 				img = img.convert(img.mode)
@@ -84,49 +238,97 @@ def optimize_image(image_data, resize=True, max_width=512, max_height=342,
 		img.save(output, format=save_format, optimize=True)
 		return output.getvalue()
 		
+	except ImageTooLarge:
+		raise
+	except Image.DecompressionBombError as e:
+		raise ImageTooLarge(str(e))
 	except Exception as e:
 		print(f"Error optimizing image: {str(e)}")
 		return image_data
 
+def conversion_settings(resize=True, max_width=512, max_height=342,
+						convert=True, convert_to='gif', dithering='FLOYDSTEINBERG', resize_quality=RESIZE_QUALITY,
+						color_mode=COLOR_MODE):
+	return {
+		"resize": resize,
+		"max_width": max_width,
+		"max_height": max_height,
+		"convert": convert,
+		"convert_to": convert_to,
+		"dithering": resolve_dithering(dithering),
+		"resize_quality": resize_quality,
+		"color_mode": resolve_color_mode(color_mode),
+	}
+
+def cached_image_name(name, settings):
+	"""
+	File name of image `name` converted with `settings`. A fingerprint of the
+	settings is part of the name, so one cache can hold an image converted for
+	several presets, and changing the settings never serves a stale conversion.
+	"""
+	extension = settings["convert_to"].lower() if settings["convert"] and settings["convert_to"] else "gif"
+	fingerprint = hashlib.md5(repr(sorted(settings.items())).encode()).hexdigest()[:8]
+	return f"{name}-{fingerprint}.{extension}"
+
+def is_cached_image_name(file_name):
+	"""
+	Whether `file_name` looks like a name cached_image_name() gives out: an
+	MD5 hex digest, the settings fingerprint and an extension. Names come from
+	request paths, so anything else (such as "../config.py") must never reach
+	the file system.
+	"""
+	return os.path.basename(file_name) == file_name and CACHED_IMAGE_NAME.fullmatch(file_name) is not None
+
 def fetch_and_cache_image(url, content=None, resize=True, max_width=512, max_height=342,
 						 convert=True, convert_to='gif', dithering='FLOYDSTEINBERG',
-						 hash_url=True):
+						 hash_url=True, resize_quality=RESIZE_QUALITY, color_mode=COLOR_MODE):
 	try:
 		print(f"Processing image: {url}")
 		
 		# Generate filename with appropriate extension
-		extension = convert_to.lower() if convert and convert_to else "gif"
-		if hash_url:
-			file_name = hashlib.md5(url.encode()).hexdigest() + f".{extension}"
-		else:
-			file_name = url + f".{extension}"
-		file_path = os.path.join(CACHE_DIR, file_name)
+		settings = conversion_settings(resize, max_width, max_height, convert, convert_to, dithering,
+			resize_quality, color_mode)
+		name = hashlib.md5(url.encode()).hexdigest() if hash_url else url
+		file_name = cached_image_name(name, settings)
 		
-		if not os.path.exists(file_path):
-			print(f"Optimizing and caching image: {url}")
-			if content is None:
-				response = requests.get(url, stream=True, headers={"User-Agent": USER_AGENT})
-				response.raise_for_status()
-				content = response.content
-			
-			# Only process if image conversion or resizing is enabled
-			if convert or resize:
-				optimized_image = optimize_image(
-					content,
-					resize=resize,
-					max_width=max_width,
-					max_height=max_height,
-					convert=convert,
-					convert_to=convert_to,
-					dithering=dithering
-				)
-			else:
-				optimized_image = content
-				
-			with open(file_path, 'wb') as f:
-				f.write(optimized_image)
+		if not image_cache.contains(file_name):
+			# Requests for an image that's already being converted wait for that conversion
+			with pending_lock:
+				future = pending_images.get(file_name)
+				is_owner = future is None and not image_cache.contains(file_name)
+				if is_owner:
+					future = Future()
+					pending_images[file_name] = future
+			if is_owner:
+				try:
+					print(f"Optimizing and caching image: {url}")
+					if content is None:
+						response = requests.get(url, stream=True, headers={"User-Agent": USER_AGENT}, timeout=IMAGE_FETCH_TIMEOUT)
+						response.raise_for_status()
+						content = read_image(response)
+
+					# Only process if image conversion or resizing is enabled
+					if convert or resize:
+						optimized_image = convert_image(content, settings)
+					else:
+						optimized_image = content
+
+					image_cache.store(file_name, optimized_image)
+					future.set_result(file_name)
+				except Exception as e:
+					future.set_exception(e)
+				finally:
+					with pending_lock:
+						pending_images.pop(file_name, None)
+			elif future is not None:
+				print(f"Waiting for the conversion already under way: {url}")
+				count_image_stat("coalesced")
+			if future is not None:
+				# Raises if the conversion failed
+				future.result()
 		else:
 			print(f"Image already cached: {url}")
+			image_cache.touch(file_name)
 		
 		cached_url = f"/cached_image/{file_name}"
 		print(f"Cached URL: {cached_url}")
@@ -136,6 +338,167 @@ def fetch_and_cache_image(url, content=None, resize=True, max_width=512, max_hei
 		print(f"Error processing image: {url}, Error: {str(e)}")
 		return None
 
-# Ensure cache directory exists
-if not os.path.exists(CACHE_DIR):
-	os.makedirs(CACHE_DIR)
+# Chosen once, rather than searching the PATH for every image
+svg_renderer = get_svg_renderer()
+print(f"Rasterizing SVG images with {svg_renderer}")
+
+# Futures of the images this process is converting, by file name
+pending_images = {}
+pending_lock = threading.Lock()
+executor = None
+executor_pid = None
+
+queue_slots = threading.BoundedSemaphore(IMAGE_QUEUE_SIZE)
+image_stats = {
+	"waiting": 0,
+	"queue_depth": 0,
+	"converted": 0,
+	"coalesced": 0,
+	"seconds_total": 0.0,
+	"seconds_max": 0.0,
+}
+image_stats_lock = threading.Lock()
+
+def count_image_stat(key, amount=1):
+	with image_stats_lock:
+		image_stats[key] += amount
+
+def get_image_stats():
+	with image_stats_lock:
+		stats = dict(image_stats)
+	stats["seconds_total"] = round(stats["seconds_total"], 3)
+	stats["seconds_max"] = round(stats["seconds_max"], 3)
+	stats["seconds_average"] = round(stats["seconds_total"] / stats["converted"], 3) if stats["converted"] else 0.0
+	stats["cache"] = image_cache.stats()
+	return stats
+
+def timed_optimize_image(content, settings):
+	"""
+	optimize_image(), and how long it took. Runs in an image worker process
+	if there are any, see pool_utils.run_job().
+	"""
+	start = time.perf_counter()
+	return optimize_image(content, **settings), time.perf_counter() - start
+
+def convert_image(content, settings):
+	"""
+	Runs optimize_image() in the image worker processes if there are any,
+	else on this thread, once one of the IMAGE_QUEUE_SIZE slots is free.
+	"""
+	count_image_stat("waiting")
+	with queue_slots:
+		with image_stats_lock:
+			image_stats["waiting"] -= 1
+			image_stats["queue_depth"] += 1
+		try:
+			result = run_in_pool("image", timed_optimize_image, content, settings)
+			if result is None:
+				result = timed_optimize_image(content, settings)
+		finally:
+			count_image_stat("queue_depth", -1)
+	optimized, seconds = result
+	with image_stats_lock:
+		image_stats["converted"] += 1
+		image_stats["seconds_total"] += seconds
+		image_stats["seconds_max"] = max(image_stats["seconds_max"], seconds)
+	return optimized
+
+def get_executor():
+	# Threads don't survive a fork, so each worker process starts its own pool
+	global executor, executor_pid
+	if executor_pid != os.getpid():
+		executor = ThreadPoolExecutor(max_workers=SVG_RASTERIZE_THREADS, thread_name_prefix="rasterize")
+		executor_pid = os.getpid()
+	return executor
+
+def queue_image(name, content, resize=True, max_width=512, max_height=342,
+				convert=True, convert_to='gif', dithering='FLOYDSTEINBERG', resize_quality=RESIZE_QUALITY,
+				color_mode=COLOR_MODE):
+	"""
+	Like fetch_and_cache_image(content=..., hash_url=False), but returns the
+	cached URL straight away and converts the image in the background.
+	Identical images (same name) are only converted once.
+	"""
+	settings = conversion_settings(resize, max_width, max_height, convert, convert_to, dithering,
+		resize_quality, color_mode)
+	file_name = cached_image_name(name, settings)
+	file_path = image_cache.path_for(file_name)
+	cached_url = f"/cached_image/{file_name}"
+
+	with pending_lock:
+		if file_name in pending_images:
+			count_image_stat("coalesced")
+			return cached_url
+		if os.path.exists(file_path) or os.path.exists(file_path + PENDING_SUFFIX):
+			return cached_url
+
+		write_atomically(file_path + PENDING_SUFFIX, pickle.dumps((content, settings)))
+		future = get_executor().submit(convert_pending_image, file_name)
+		pending_images[file_name] = future
+
+	future.add_done_callback(lambda _: pending_images.pop(file_name, None))
+	print(f"Queued image: {cached_url}")
+	return cached_url
+
+def load_spool(path):
+	"""
+	Unpickles a spooled image, but only one this cache could have written: a
+	regular file (not a symlink) inside the cache directory, owned by the user
+	this process runs as. Returns None for anything else.
+	"""
+	cache_dir = os.path.realpath(image_cache.cache_dir)
+	if os.path.commonpath((cache_dir, os.path.realpath(os.path.dirname(path)))) != cache_dir:
+		return None
+	try:
+		with open(os.open(path, os.O_RDONLY | os.O_NOFOLLOW), 'rb') as f:
+			spool_stat = os.fstat(f.fileno())
+			if not stat.S_ISREG(spool_stat.st_mode) or spool_stat.st_uid != os.geteuid():
+				print(f"Ignoring spooled image not written by this cache: {path}")
+				return None
+			return pickle.load(f)
+	except (OSError, EOFError, pickle.UnpicklingError):
+		return None
+
+def convert_pending_image(file_name):
+	"""
+	Converts a spooled image, unless another thread or process got to it first.
+	"""
+	if not is_cached_image_name(file_name):
+		return
+	file_path = image_cache.path_for(file_name)
+	spooled = load_spool(file_path + PENDING_SUFFIX)
+	if spooled is None:
+		return
+	content, settings = spooled
+	try:
+		print(f"Optimizing and caching image: {file_name}")
+		if settings["convert"] or settings["resize"]:
+			content = convert_image(content, settings)
+		image_cache.store(file_name, content)
+	finally:
+		try:
+			os.unlink(file_path + PENDING_SUFFIX)
+		except OSError:
+			pass
+
+def wait_for_image(file_name):
+	"""
+	Makes sure a queued image has been converted before it's served, and
+	marks it as recently used.
+	"""
+	if not is_cached_image_name(file_name):
+		return
+	future = pending_images.get(file_name)
+	if future is not None:
+		try:
+			future.result()
+		except Exception as e:
+			print(f"Error processing image: {file_name}, Error: {str(e)}")
+	elif os.path.exists(image_cache.path_for(file_name) + PENDING_SUFFIX):
+		# Queued by another worker process (or its thread hasn't started yet)
+		convert_pending_image(file_name)
+	image_cache.touch(file_name)
+
+# Build the configured palette's lookup table up front, so worker processes inherit it
+if COLOR_MODE in COLOR_MODES:
+	get_palette(COLOR_MODE)
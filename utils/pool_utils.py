@@ -0,0 +1,121 @@
+# Standard library imports
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+
+# First-party imports
+from utils.system_utils import load_preset
+
+# Get config
+config = load_preset()
+
+# Transcode pages in this many worker processes, so that a huge page doesn't
+# hold the GIL while every other client waits. 0 transcodes on the request thread.
+TRANSCODE_PROCESSES = getattr(config, 'TRANSCODE_PROCESSES', 0)
+
+# Pages smaller than this are transcoded on the request thread anyway, as
+# sending them to a worker and back costs more than it saves
+TRANSCODE_POOL_MIN_BYTES = getattr(config, 'TRANSCODE_POOL_MIN_BYTES', 64 * 1024)
+
+# Convert images (decode, resize, dither, encode) in this many worker processes,
+# so a page full of thumbnails uses every core. 0 converts them on threads.
+IMAGE_PROCESSES = getattr(config, 'IMAGE_PROCESSES', 0)
+
+# Pages (and transcoded output) at least this big are passed between processes
+# in shared memory, rather than pickled through a pipe
+SHARED_MEMORY_MIN_BYTES = 1024 * 1024
+
+# Running worker pools, by name ("transcode", "image")
+pools = {}
+
+
+def start_worker_pools():
+	"""
+	Starts the worker processes. They're forked, and inherit the loaded
+	config and extensions, so this has to be called while the process has
+	no other threads: before the server starts, or in each prefork worker
+	before it starts serving.
+	"""
+	if pools:
+		return
+	for name, processes in (("transcode", TRANSCODE_PROCESSES), ("image", IMAGE_PROCESSES)):
+		if not processes:
+			continue
+		# Workers have to share this process's resource tracker, see load_payload()
+		resource_tracker.ensure_running()
+		pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'))
+		# With fork, the first job starts every worker; have that happen now
+		pool.submit(os.getpid).result()
+		pools[name] = pool
+		print(f"Started {processes} {name} worker processes")
+
+def stop_worker_pools():
+	while pools:
+		name, pool = pools.popitem()
+		pool.shutdown(cancel_futures=True)
+
+def has_pool(name):
+	return name in pools
+
+def use_transcode_pool(size):
+	return has_pool("transcode") and size >= TRANSCODE_POOL_MIN_BYTES
+
+def dump_payload(data):
+	"""
+	Wraps bytes to be sent to another process, copying large ones into a
+	shared memory block that the receiving side unlinks
+	"""
+	if len(data) < SHARED_MEMORY_MIN_BYTES:
+		return data
+	block = shared_memory.SharedMemory(create=True, size=len(data))
+	block.buf[:len(data)] = data
+	name = block.name
+	block.close()
+	return (name, len(data))
+
+def load_payload(payload):
+	if isinstance(payload, bytes):
+		return payload
+	name, size = payload
+	# Attaching registers the block with the resource tracker too, but all
+	# processes share one tracker, which forgets it once it's unlinked
+	block = shared_memory.SharedMemory(name=name)
+	try:
+		return bytes(block.buf[:size])
+	finally:
+		block.close()
+		block.unlink()
+
+def run_job(function, payload, args, kwargs):
+	"""
+	Runs in a worker process: function(data, ...) returns bytes, and
+	anything else to pass back alongside them
+	"""
+	output, *extra = function(load_payload(payload), *args, **kwargs)
+	return dump_payload(output), extra
+
+def run_in_pool(name, function, data, *args, **kwargs):
+	"""
+	Runs function(data, *args, **kwargs) in the named pool, and returns its
+	(bytes, *extra) result. Returns None if there's no such pool, or it has
+	stopped working, for the caller to do the work itself.
+	"""
+	pool = pools.get(name)
+	if pool is None:
+		return None
+	payload = dump_payload(data)
+	try:
+		output, extra = pool.submit(run_job, function, payload, args, kwargs).result()
+	except BrokenProcessPool as e:
+		print(f"The {name} pool stopped working, doing its work on threads from now on: {str(e)}")
+		pools.pop(name, None)
+		if not isinstance(payload, bytes):
+			# The worker may not have got as far as unlinking the input
+			try:
+				load_payload(payload)
+			except FileNotFoundError:
+				pass
+		return None
+	return (load_payload(output), *extra)
@@ -0,0 +1,176 @@
+# Standard library imports
+import os
+import queue
+import signal
+import threading
+import time
+
+# Third-party imports
+from werkzeug.serving import BaseWSGIServer
+
+
+BUSY_RESPONSE = (
+	b"HTTP/1.0 503 Service Unavailable\r\n"
+	b"Content-Type: text/html\r\n"
+	b"Retry-After: 5\r\n"
+	b"Connection: close\r\n"
+	b"\r\n"
+	b"<html><body><p>Macproxy is busy. Please try again in a moment.</p></body></html>"
+)
+
+class PooledWSGIServer(BaseWSGIServer):
+	"""
+	WSGI server that hands accepted connections to a fixed pool of worker
+	threads. Connections wait in a bounded queue; once it is full, new
+	clients are turned away with a 503 instead of piling up.
+	"""
+
+	multithread = True
+
+	def __init__(self, host, port, app, threads=8, max_pending=64, **kwargs):
+		super().__init__(host, port, app, **kwargs)
+		self.threads = threads
+		self.pending = queue.Queue(maxsize=max_pending)
+		self.workers = []
+
+	def serve_forever(self, poll_interval=0.5):
+		# Worker threads are started here rather than in __init__, so a
+		# prefork parent can bind the socket and fork before any exist.
+		if not self.workers:
+			for i in range(self.threads):
+				worker = threading.Thread(target=self.worker_loop, name=f"macproxy-worker-{i}", daemon=True)
+				worker.start()
+				self.workers.append(worker)
+		super().serve_forever(poll_interval=poll_interval)
+
+	def process_request(self, request, client_address):
+		try:
+			self.pending.put_nowait((request, client_address))
+		except queue.Full:
+			print(f"Request queue full, rejecting connection from {client_address[0]}")
+			self.reject_request(request)
+
+	def reject_request(self, request):
+		try:
+			request.sendall(BUSY_RESPONSE)
+		except OSError:
+			pass
+		self.shutdown_request(request)
+
+	def worker_loop(self):
+		while True:
+			request, client_address = self.pending.get()
+			try:
+				self.finish_request(request, client_address)
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				self.shutdown_request(request)
+				self.pending.task_done()
+
+	def drain(self, timeout):
+		"""
+		Wait for queued and in-flight requests to finish, up to `timeout` seconds.
+		Returns True if every request completed.
+		"""
+		deadline = time.monotonic() + timeout
+		while self.pending.unfinished_tasks:
+			if time.monotonic() >= deadline:
+				return False
+			time.sleep(0.05)
+		return True
+
+def install_shutdown_handlers(server):
+	"""
+	Stop accepting connections on SIGINT/SIGTERM. `shutdown()` blocks until
+	`serve_forever()` returns, so it has to run outside the signal handler.
+	"""
+	def handle_signal(signum, frame):
+		print(f"Received signal {signum}, shutting down")
+		threading.Thread(target=server.shutdown, daemon=True).start()
+
+	signal.signal(signal.SIGINT, handle_signal)
+	signal.signal(signal.SIGTERM, handle_signal)
+
+def serve_production(app, host, port, threads=8, max_pending=64, shutdown_timeout=30):
+	server = PooledWSGIServer(host, port, app, threads=threads, max_pending=max_pending)
+	install_shutdown_handlers(server)
+	print(f"Serving on {host}:{server.port} with {threads} worker threads (queue size {max_pending})")
+	try:
+		server.serve_forever()
+	finally:
+		print("Waiting for in-flight requests to finish")
+		if not server.drain(shutdown_timeout):
+			print(f"Gave up on unfinished requests after {shutdown_timeout} seconds")
+
+def run_worker(server, shutdown_timeout):
+	install_shutdown_handlers(server)
+	try:
+		server.serve_forever()
+	finally:
+		server.drain(shutdown_timeout)
+
+def serve_prefork(app, host, port, workers=2, threads=8, max_pending=64, shutdown_timeout=30,
+				  on_worker_start=None, on_worker_exit=None):
+	"""
+	Bind once, then fork `workers` processes that all accept connections from
+	the same listening socket. Anything loaded before this call (config,
+	extensions) is inherited by every worker. The parent restarts workers
+	that die and forwards SIGINT/SIGTERM to them on shutdown.
+	`on_worker_start` is called in each worker before its threads start, and
+	`on_worker_exit` once it has stopped serving (workers leave with
+	os._exit(), which skips atexit handlers).
+	"""
+	server = PooledWSGIServer(host, port, app, threads=threads, max_pending=max_pending)
+	children = set()
+	stopping = False
+
+	def spawn():
+		pid = os.fork()
+		if pid == 0:
+			status = 0
+			try:
+				if on_worker_start:
+					on_worker_start()
+				run_worker(server, shutdown_timeout)
+			except BaseException:
+				status = 1
+			finally:
+				try:
+					if on_worker_exit:
+						on_worker_exit()
+				finally:
+					os._exit(status)
+		children.add(pid)
+		return pid
+
+	def handle_signal(signum, frame):
+		nonlocal stopping
+		stopping = True
+		for pid in list(children):
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+
+	print(f"Serving on {host}:{server.port} with {workers} worker processes, {threads} threads each (queue size {max_pending})")
+	for _ in range(workers):
+		spawn()
+	signal.signal(signal.SIGINT, handle_signal)
+	signal.signal(signal.SIGTERM, handle_signal)
+
+	while children:
+		try:
+			pid, status = os.wait()
+		except ChildProcessError:
+			break
+		except InterruptedError:
+			continue
+		children.discard(pid)
+		if not stopping:
+			print(f"Worker {pid} exited unexpectedly (status {status}), starting a replacement")
+			time.sleep(1)
+			spawn()
+
+	server.server_close()
+	print("All workers stopped")
@@ -0,0 +1,166 @@
+# Standard library imports
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+
+# Third-party imports
+from flask import g, has_request_context, request
+
+# First-party imports
+from utils.cache_utils import LRUCache
+from utils.system_utils import load_preset
+
+# Get config
+config = load_preset()
+
+# How clients are told apart: "ip" (remote address) or "cookie"
+CLIENT_ID_MODE = getattr(config, 'STATE_CLIENT_ID', 'ip')
+CLIENT_COOKIE = "macproxy_client"
+MAX_ENTRIES = getattr(config, 'STATE_MAX_ENTRIES', 10000)
+
+
+class MemoryBackend:
+	"""
+	Keeps state in an in-process LRU cache. Only visible to the current process.
+	"""
+
+	def __init__(self, max_entries=MAX_ENTRIES):
+		self.cache = LRUCache(max_entries=max_entries)
+
+	def get(self, key, default=None):
+		return self.cache.get(key, default)
+
+	def set(self, key, value):
+		self.cache.set(key, value)
+
+	def delete(self, key):
+		self.cache.delete(key)
+
+class SQLiteBackend:
+	"""
+	Keeps state in a SQLite file, so every worker process sees the same values.
+	Values are pickled, so anything picklable can be stored. Once the table
+	grows past `max_entries`, the least recently written keys are pruned.
+	"""
+
+	def __init__(self, path, max_entries=MAX_ENTRIES):
+		self.path = path
+		self.max_entries = max_entries
+		self.writes = 0
+		self.local = threading.local()
+		self.connect().execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value BLOB, updated REAL)")
+
+	def connect(self):
+		# sqlite connections can't be shared between threads, and must not be
+		# reused in a child process after a fork.
+		if getattr(self.local, 'pid', None) != os.getpid():
+			conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+			conn.execute("PRAGMA journal_mode=WAL")
+			self.local.conn = conn
+			self.local.pid = os.getpid()
+		return self.local.conn
+
+	def get(self, key, default=None):
+		row = self.connect().execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+		return pickle.loads(row[0]) if row else default
+
+	def set(self, key, value):
+		conn = self.connect()
+		conn.execute(
+			"INSERT OR REPLACE INTO state (key, value, updated) VALUES (?, ?, ?)",
+			(key, pickle.dumps(value), time.time())
+		)
+		self.writes += 1
+		if self.writes % 100 == 0:
+			conn.execute(
+				"DELETE FROM state WHERE key IN (SELECT key FROM state ORDER BY updated DESC LIMIT -1 OFFSET ?)",
+				(self.max_entries,)
+			)
+
+	def delete(self, key):
+		self.connect().execute("DELETE FROM state WHERE key = ?", (key,))
+
+backend = MemoryBackend()
+
+def set_backend(new_backend):
+	"""
+	Replace the state store. Any object with get(key, default), set(key, value)
+	and delete(key) methods can be used, e.g. a wrapper around Redis.
+	Must be called before worker processes are forked.
+	"""
+	global backend
+	backend = new_backend
+	print(f"Using state store: {type(new_backend).__name__}")
+
+def use_shared_backend(path, reset=True):
+	"""
+	Switch to a SQLite store at `path`. With `reset`, any previous contents
+	are discarded.
+	"""
+	if reset:
+		for suffix in ('', '-wal', '-shm'):
+			if os.path.exists(path + suffix):
+				os.unlink(path + suffix)
+	set_backend(SQLiteBackend(path))
+
+def is_shared_backend():
+	return not isinstance(backend, MemoryBackend)
+
+def get_client_id():
+	"""
+	Identify the client behind the current request. Outside of a request
+	(e.g. at import time) everything maps to a single "global" client.
+	"""
+	if not has_request_context():
+		return "global"
+	if CLIENT_ID_MODE == "cookie":
+		client_id = request.cookies.get(CLIENT_COOKIE)
+		if not client_id:
+			if 'new_client_id' not in g:
+				g.new_client_id = uuid.uuid4().hex
+			client_id = g.new_client_id
+		return client_id
+	return request.remote_addr or "unknown"
+
+def attach_client_cookie(response):
+	"""
+	Hand a newly assigned client id back to the browser (cookie mode only).
+	"""
+	if has_request_context() and 'new_client_id' in g:
+		response.set_cookie(CLIENT_COOKIE, g.new_client_id, max_age=60 * 60 * 24 * 365)
+	return response
+
+class SharedState:
+	"""
+	Namespaced view of the state store, e.g. SharedState("chatgpt"), whose
+	values are the same for every client. Always goes through the current
+	backend, so modules can create one at import time and still follow a
+	later switch to the shared backend.
+	"""
+
+	def __init__(self, namespace):
+		self.namespace = namespace
+
+	def key(self, name):
+		return f"{self.namespace}:{name}"
+
+	def get(self, name, default=None):
+		return backend.get(self.key(name), default)
+
+	def set(self, name, value):
+		backend.set(self.key(name), value)
+
+	def delete(self, name):
+		backend.delete(self.key(name))
+
+class ClientState(SharedState):
+	"""
+	Like SharedState, but every client gets its own values, so one machine
+	enabling an override or chatting with an LLM doesn't affect the others.
+	"""
+
+	def key(self, name):
+		return f"{self.namespace}:{get_client_id()}:{name}"
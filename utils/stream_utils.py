@@ -0,0 +1,248 @@
+# Standard library imports
+import codecs
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+
+# Third-party imports
+from bs4 import BeautifulSoup
+
+# First-party imports
+from utils.html_utils import (format_start_tag, get_pipeline, is_stylesheet_link, remember_stripped_assets,
+	resolve_svg_uses, replace_svg_with_img, rewrite_url)
+from utils.system_utils import load_preset
+from utils.text_utils import META_SNIFF_BYTES, OUTPUT_ENCODING, IncrementalTransliterator, declare_charset, detect_charset, get_transliterator
+
+# Get config
+config = load_preset()
+
+# Transcode HTML as it arrives from the upstream server and send each part to
+# the browser straight away, instead of waiting for the whole page
+STREAM_HTML = getattr(config, 'STREAM_HTML', False)
+
+# Upstream HTML is read (and flushed to the client) in chunks of this size
+STREAM_HTML_CHUNK_SIZE = 8 * 1024
+
+# Elements that never have an end tag
+VOID_ELEMENTS = {
+	'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'embed', 'frame', 'hr', 'img',
+	'input', 'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr',
+}
+
+# Tags whose src and href attributes are rewritten from HTTPS to HTTP
+URL_TAGS = {'link', 'script', 'img', 'a', 'iframe'}
+
+
+class StreamingTranscoder(HTMLParser):
+	"""
+	Applies the same rules as transcode_html() token by token, as the page is
+	fed in, so output can be sent before the rest of the page has arrived.
+
+	Unlike the tree-based transcoder, text is passed through as it appears in
+	the source (entities are not decoded), and markup the upstream page left
+	unbalanced is not repaired. Inline <svg> elements are buffered until
+	they're complete, then converted on their own. A <use> tag can only refer
+	to a <symbol> that appeared earlier in the page.
+	"""
+
+	def __init__(self, url=None, whitelisted_domains=None, simplify_html=False,
+				 tags_to_unwrap=None, tags_to_strip=None, attributes_to_strip=None):
+		super().__init__(convert_charrefs=False)
+
+		# Check if domain is whitelisted
+		is_whitelisted = False
+		if url:
+			domain = urlparse(url).netloc
+			is_whitelisted = any(domain.endswith(whitelisted) for whitelisted in whitelisted_domains)
+
+		# Only perform tag/attribute stripping if the domain is not whitelisted and SIMPLIFY_HTML is True
+		self.simplify = simplify_html and not is_whitelisted
+		self.tags_to_unwrap = set(tags_to_unwrap or []) if self.simplify else set()
+		self.tags_to_strip = set(tags_to_strip or []) if self.simplify else set()
+		self.attributes_to_strip = set(attributes_to_strip or []) if self.simplify else set()
+		self.pipeline = get_pipeline(self.simplify, tags_to_unwrap, tags_to_strip, attributes_to_strip)
+
+		self.output = []
+		# Name and nesting depth of the stripped element we're inside of
+		self.stripping = None
+		self.strip_depth = 0
+		# Source of the inline <svg> being buffered, and its nesting depth
+		self.svg_source = []
+		self.svg_depth = 0
+		# <symbol> tags from earlier SVGs, by id
+		self.symbols = {}
+		self.in_style = False
+		# URLs of stripped scripts and stylesheets
+		self.stripped_assets = set()
+
+	def transcode(self, text, final=False):
+		"""
+		Feeds the next part of the page in, and returns the output it produced.
+		"""
+		self.feed(text)
+		if final:
+			self.close()
+			if self.svg_source:
+				self.flush_svg()
+		output = ''.join(self.output)
+		self.output = []
+		return output
+
+	def emit(self, text):
+		if self.svg_depth:
+			self.svg_source.append(text)
+		elif not self.stripping:
+			self.output.append(text)
+
+	def handle_starttag(self, tag, attrs):
+		self.start_tag(tag, attrs, self_closing=False)
+
+	def handle_startendtag(self, tag, attrs):
+		self.start_tag(tag, attrs, self_closing=True)
+
+	def start_tag(self, tag, attrs, self_closing):
+		if self.stripping:
+			if tag == self.stripping and not self_closing:
+				self.strip_depth += 1
+			return
+
+		if self.svg_depth or tag == 'svg':
+			# Keep the source as it was, so the case of SVG tags and attributes survives
+			if tag == 'svg' and not self_closing:
+				self.svg_depth += 1
+			if self.svg_depth:
+				self.svg_source.append(self.get_starttag_text())
+				return
+
+		if tag in self.tags_to_unwrap:
+			return
+		if tag in self.tags_to_strip:
+			values = dict(attrs)
+			if tag == 'script' and values.get('src'):
+				self.stripped_assets.add(values['src'])
+			elif is_stylesheet_link(tag, values.get('rel')) and values.get('href'):
+				self.stripped_assets.add(values['href'])
+			if not self_closing and tag not in VOID_ELEMENTS:
+				self.stripping = tag
+				self.strip_depth = 1
+			return
+
+		attrs = [(key, val) for key, val in attrs if key not in self.attributes_to_strip]
+
+		# Always convert HTTPS to HTTP regardless of whitelist status
+		if tag in URL_TAGS:
+			attrs = [(key, rewrite_url(val)) if key in ('src', 'href') and val else (key, val) for key, val in attrs]
+
+		# Always handle meta refresh tags
+		if tag == 'meta' and ('http-equiv', 'refresh') in attrs:
+			attrs = [(key, val.replace('https://', 'http://')) if key == 'content' and val else (key, val) for key, val in attrs]
+		if tag == 'meta':
+			attrs = declare_charset(attrs).items()
+
+		if tag == 'style':
+			self.in_style = True
+
+		self.output.append(format_start_tag(tag, attrs))
+
+	def handle_endtag(self, tag):
+		if self.stripping:
+			if tag == self.stripping:
+				self.strip_depth -= 1
+				if not self.strip_depth:
+					self.stripping = None
+			return
+
+		if self.svg_depth:
+			self.svg_source.append(f"</{tag}>")
+			if tag == 'svg':
+				self.svg_depth -= 1
+				if not self.svg_depth:
+					self.flush_svg()
+			return
+
+		if tag in self.tags_to_unwrap or tag in self.tags_to_strip or tag in VOID_ELEMENTS:
+			return
+		if tag == 'style':
+			self.in_style = False
+		self.output.append(f"</{tag}>")
+
+	def handle_data(self, data):
+		# Always handle CSS with inline URLs
+		if self.in_style:
+			data = data.replace('https://', 'http://')
+		self.emit(data)
+
+	def handle_entityref(self, name):
+		self.emit(f"&{name};")
+
+	def handle_charref(self, name):
+		self.emit(f"&#{name};")
+
+	def handle_comment(self, data):
+		self.emit(f"<!--{data}-->")
+
+	def handle_decl(self, decl):
+		self.emit(f"<!{decl}>")
+
+	def handle_pi(self, data):
+		self.emit(f"<?{data}>")
+
+	def unknown_decl(self, data):
+		self.emit(f"<![{data}]>")
+
+	def flush_svg(self):
+		"""
+		Runs a complete inline <svg> through the tree-based rules, and
+		replaces it with an <img> tag pointing at the converted image.
+		"""
+		source = ''.join(self.svg_source)
+		self.svg_source = []
+		self.svg_depth = 0
+
+		soup = BeautifulSoup(source, 'html5lib')
+		context = self.pipeline.run(soup)
+		self.symbols.update((key, tag) for key, tag in context.symbols.items() if key not in self.symbols)
+		context.symbols = self.symbols
+		resolve_svg_uses(context)
+		for tag in context.svg_tags:
+			img = replace_svg_with_img(soup, tag, context)
+			if img.parent is not None and img.parent.name == 'body':
+				self.output.append(format_start_tag('img', img.attrs.items()))
+
+def stream_transcode_html(chunks, url=None, whitelisted_domains=None, simplify_html=False,
+						  tags_to_unwrap=None, tags_to_strip=None, attributes_to_strip=None,
+						  convert_characters=False, conversion_table=None, charset=None):
+	"""
+	Transcodes an iterable of byte chunks of an HTML page, yielding the
+	transcoded page in byte chunks as soon as each part is ready. The
+	page's encoding is detected from the charset its Content-Type header
+	declared, or the start of the page, which is held back until it's long
+	enough to contain any <meta> charset declaration.
+	"""
+	decoder = None
+	head = b''
+	converter = IncrementalTransliterator(get_transliterator(conversion_table)) if convert_characters else None
+	transcoder = StreamingTranscoder(url, whitelisted_domains, simplify_html,
+		tags_to_unwrap, tags_to_strip, attributes_to_strip)
+
+	def transcode(chunk, final=False):
+		nonlocal decoder, head
+		if decoder is None:
+			head += chunk
+			if len(head) < META_SNIFF_BYTES and not final:
+				return b''
+			decoder = codecs.getincrementaldecoder(detect_charset(head, charset))(errors='replace')
+			chunk, head = head, b''
+		text = decoder.decode(chunk, final)
+		# Handle character conversion regardless of whitelist status
+		if converter:
+			text = converter.convert(text, final)
+		return transcoder.transcode(text, final).encode(OUTPUT_ENCODING, errors='xmlcharrefreplace')
+
+	for chunk in chunks:
+		output = transcode(chunk)
+		if output:
+			yield output
+	output = transcode(b'', final=True)
+	remember_stripped_assets(url, transcoder.stripped_assets)
+	if output:
+		yield output
@@ -46,12 +46,16 @@ def load_preset():
 			'RESIZE_IMAGES',
 			'MAX_IMAGE_WIDTH',
 			'MAX_IMAGE_HEIGHT',
+			'IMAGE_RESIZE_QUALITY',
 			'CONVERT_IMAGES',
 			'CONVERT_IMAGES_TO_FILETYPE',
+			'IMAGE_COLOR_MODE',
 			'DITHERING_ALGORITHM',
 			'WEB_SIMULATOR_PROMPT_ADDENDUM',
 			'CONVERT_CHARACTERS',
-			'CONVERSION_TABLE'
+			'CONVERSION_TABLE',
+			'CONVERSION_FALLBACK_NFKD',
+			'OUTPUT_ENCODING'
 		]
 
 		changes_made = False
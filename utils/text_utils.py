@@ -0,0 +1,244 @@
+# Standard library imports
+import codecs
+import re
+import unicodedata
+
+# First-party imports
+from utils.system_utils import load_preset
+
+# Get config
+config = load_preset()
+
+# Transliterate characters that aren't in CONVERSION_TABLE to their closest
+# ASCII form (e.g. "ü" -> "u"), when Unicode decomposition yields one
+FALLBACK_NFKD = getattr(config, 'CONVERSION_FALLBACK_NFKD', False)
+
+NON_ASCII_PATTERN = re.compile(r'[^\x00-\x7f]')
+
+# Transcoded pages are sent to the browser in this encoding
+OUTPUT_ENCODING = getattr(config, 'OUTPUT_ENCODING', 'utf-8')
+
+# Byte order marks, and the codecs that decode (and drop) them
+BYTE_ORDER_MARKS = (
+	(codecs.BOM_UTF8, 'utf-8-sig'),
+	(codecs.BOM_UTF16_LE, 'utf-16'),
+	(codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+# A <meta charset> (or http-equiv Content-Type) declaration must appear
+# within the first 1024 bytes of a page
+META_SNIFF_BYTES = 1024
+META_CHARSET_PATTERN = re.compile(rb'''<meta[^>]*?charset\s*=\s*["']?\s*([\w.:-]+)''', re.IGNORECASE)
+CHARSET_PARAMETER_PATTERN = re.compile(r'''(charset\s*=\s*["']?)([\w.:-]+)''', re.IGNORECASE)
+
+# Browsers decode pages labelled with these as windows-1252
+WINDOWS_1252_CODECS = {'ascii', 'iso8859-1'}
+
+# Compiled transliterators by id() of their conversion table, see get_transliterator()
+transliterators = {}
+
+
+def compile_keys(keys):
+	"""
+	Compiles keys into one regex, sharing common prefixes the way a trie
+	would, e.g. ["&rarr;", "&raquo;"] -> "&ra(?:quo;|rr;)". A plain
+	alternation would try every key at every position of the text.
+	"""
+	trie = {}
+	for key in keys:
+		node = trie
+		for char in key:
+			node = node.setdefault(char, {})
+		node[''] = True
+
+	def to_pattern(node):
+		branches = [re.escape(char) + to_pattern(child) for char, child in sorted(node.items()) if char]
+		if not branches:
+			return ''
+		pattern = branches[0] if len(branches) == 1 and '' not in node else '(?:' + '|'.join(branches) + ')'
+		return pattern + '?' if '' in node else pattern
+
+	return re.compile(to_pattern(trie))
+
+class Transliterator:
+	"""
+	Applies a CONVERSION_TABLE in a single pass over the text: one trie-shaped
+	regex for multi-character keys such as HTML entities, then a character
+	class for single characters (much faster than str.translate() when most
+	replacements are longer than one character).
+
+	The table used to be applied one key at a time, in order. That gives the
+	same result as a single pass unless keys overlap each other or a
+	replacement contains a key, so such tables keep the sequential behavior.
+	A single pass can also miss a key that the sequential replacements would
+	have assembled from neighbouring text (e.g. "&" + "¢" -> "cent" + ";"),
+	so any text left containing a key is converted sequentially instead.
+	"""
+
+	def __init__(self, conversion_table, fallback_nfkd=FALLBACK_NFKD):
+		self.replacements = [
+			(key, replacement.decode("utf-8") if isinstance(replacement, bytes) else replacement)
+			for key, replacement in conversion_table.items()
+		]
+		self.fallback_nfkd = fallback_nfkd
+		self.fallback_cache = {}
+
+		self.table = dict(self.replacements)
+		multi_char_keys = [key for key in self.table if len(key) > 1]
+		single_chars = [key for key in self.table if len(key) == 1]
+		self.multi_char_pattern = compile_keys(multi_char_keys) if multi_char_keys else None
+		self.single_char_pattern = re.compile('[' + ''.join(map(re.escape, single_chars)) + ']') if single_chars else None
+		self.single_pass = self.is_single_pass_safe(self.table)
+
+		# Used when converting text that arrives in chunks, see IncrementalTransliterator
+		self.key_prefixes = {key[:i] for key in multi_char_keys for i in range(1, len(key))}
+		self.max_key_length = max(map(len, multi_char_keys), default=1)
+
+	@staticmethod
+	def is_single_pass_safe(table):
+		keys = [key for key in table if key]
+		for key in keys:
+			for other in keys:
+				if other == key:
+					continue
+				# One key inside another, or the end of one key starting another
+				if other in key or any(key.endswith(other[:i]) for i in range(1, min(len(key), len(other)))):
+					return False
+		return not any(key in replacement for replacement in table.values() for key in keys)
+
+	def convert_sequentially(self, text):
+		for key, replacement in self.replacements:
+			text = text.replace(key, replacement)
+		return text
+
+	def replace(self, match):
+		return self.table[match.group()]
+
+	def fallback(self, match):
+		char = match.group()
+		replacement = self.fallback_cache.get(char)
+		if replacement is None:
+			decomposed = unicodedata.normalize('NFKD', char)
+			ascii_only = ''.join(c for c in decomposed if not unicodedata.combining(c))
+			replacement = ascii_only if ascii_only.isascii() else char
+			self.fallback_cache[char] = replacement
+		return replacement
+
+	def convert(self, text):
+		if not self.replacements:
+			converted = text
+		elif not self.single_pass:
+			converted = self.convert_sequentially(text)
+		else:
+			# Replacements never contain keys, so the second pass only sees original text
+			converted = text
+			if self.multi_char_pattern is not None:
+				converted = self.multi_char_pattern.sub(self.replace, converted)
+			if self.single_char_pattern is not None:
+				converted = self.single_char_pattern.sub(self.replace, converted)
+			if self.multi_char_pattern is not None and self.multi_char_pattern.search(converted):
+				converted = self.convert_sequentially(text)
+		if self.fallback_nfkd and not converted.isascii():
+			converted = NON_ASCII_PATTERN.sub(self.fallback, converted)
+		return converted
+
+class IncrementalTransliterator:
+	"""
+	Converts text that arrives in chunks, like codecs' incremental decoders.
+	The end of a chunk that could be the start of a key (e.g. "&nbs") is held
+	back until the next chunk shows whether the key is complete.
+	"""
+
+	def __init__(self, transliterator):
+		self.transliterator = transliterator
+		self.pending = ''
+
+	def convert(self, text, final=False):
+		pending = self.pending + text
+		cut = len(pending)
+		if not final:
+			start = max(0, len(pending) - self.transliterator.max_key_length + 1)
+			for i in range(start, len(pending)):
+				if pending[i:] in self.transliterator.key_prefixes:
+					cut = i
+					break
+		self.pending = pending[cut:]
+		return self.transliterator.convert(pending[:cut])
+
+def get_transliterator(conversion_table):
+	"""
+	Returns the compiled Transliterator for a conversion table, building it
+	the first time the table is seen.
+	"""
+	entry = transliterators.get(id(conversion_table))
+	if entry is None or entry[0] is not conversion_table:
+		# A copy of a table that's already compiled, e.g. unpickled in a worker process
+		transliterator = next((t for table, t in transliterators.values() if table == conversion_table), None)
+		entry = (conversion_table, transliterator or Transliterator(conversion_table))
+		transliterators[id(conversion_table)] = entry
+	return entry[1]
+
+def convert_characters(text, conversion_table):
+	return get_transliterator(conversion_table).convert(text)
+
+def codec_name(label):
+	"""
+	Python's name for a charset label, or None if it isn't one
+	"""
+	try:
+		name = codecs.lookup(label.strip()).name
+	except (LookupError, ValueError):
+		return None
+	return 'cp1252' if name in WINDOWS_1252_CODECS else name
+
+def same_encoding(label, other):
+	return codec_name(label) == codec_name(other)
+
+def charset_from_content_type(content_type):
+	match = CHARSET_PARAMETER_PATTERN.search(content_type or '')
+	return match.group(2) if match else None
+
+def set_charset(content_type, encoding):
+	"""
+	Replaces the charset parameter of a Content-Type value, if it has one
+	"""
+	return CHARSET_PARAMETER_PATTERN.sub(lambda match: match.group(1) + encoding, content_type)
+
+def detect_charset(data, declared=None):
+	"""
+	The codec to decode a page with: from a byte order mark, else the
+	charset declared in the Content-Type header, else a <meta> tag near the
+	start of the page, else UTF-8.
+	"""
+	for mark, name in BYTE_ORDER_MARKS:
+		if data.startswith(mark):
+			return name
+	meta = META_CHARSET_PATTERN.search(data, 0, META_SNIFF_BYTES)
+	for label in (declared, meta and meta.group(1).decode('ascii')):
+		name = label and codec_name(label)
+		if name:
+			return name
+	return 'utf-8'
+
+def decode_html(data, declared=None):
+	return data.decode(detect_charset(data, declared), errors='replace')
+
+def declare_charset(attrs, encoding=OUTPUT_ENCODING):
+	"""
+	Makes the attributes of a <meta> tag declare the encoding the page is
+	actually sent in, if they declare a charset at all
+	"""
+	attrs = dict(attrs)
+	charset = attrs.get('charset')
+	if isinstance(charset, str) and not same_encoding(charset, encoding):
+		attrs['charset'] = encoding
+	content = attrs.get('content')
+	if isinstance(content, str) and str(attrs.get('http-equiv', '')).lower() == 'content-type':
+		declared = charset_from_content_type(content)
+		if declared and not same_encoding(declared, encoding):
+			attrs['content'] = set_charset(content, encoding)
+	return attrs
+
+# Compile the configured table up front, rather than on the first page
+if getattr(config, 'CONVERSION_TABLE', None):
+	get_transliterator(config.CONVERSION_TABLE)